@@ -0,0 +1,127 @@
+"""achievements module. Contains the achievement rules and the engine that evaluates
+all of them together over the cube of a DataManager"""
+from collections import namedtuple
+import operator
+
+import numpy as np
+
+# An achievement. The streams it counts are the ones that match every given
+# dimension: tracks (exact names), track_prefix, artists (exact names),
+# top_artists (the top N artists by hours) and dates ((month, day) pairs).
+# aggregate is computed over them and compared with threshold:
+#   'hours': hours played
+#   'share': hours played over the hours played of every stream
+#   'days': distinct days streamed, threshold can be 'period' for the days of
+#           the period
+# Lists are stored as tuples, so rules can be hashed and their results memoized
+class Rule(namedtuple('Rule', ['name', 'tracks', 'track_prefix', 'artists', 'top_artists',
+                               'dates', 'aggregate', 'comparison', 'threshold'],
+                      defaults=[None, None, None, None, None, 'hours', '>=', 0])):
+    """An achievement rule, see the fields above"""
+    __slots__ = ()
+
+    def __new__(cls, *args, **kwargs):
+        rule = super().__new__(cls, *args, **kwargs)
+        return rule._make(_frozen(value) for value in rule)
+
+
+def _frozen(value):
+    """Returns value with its lists, also the nested ones, as tuples"""
+    if isinstance(value, (list, tuple)):
+        return tuple(_frozen(item) for item in value)
+    return value
+
+
+COMPARISONS = {'>=': operator.ge, '>': operator.gt, '<=': operator.le, '<': operator.lt,
+               '==': operator.eq}
+
+RULES = (Rule('all_i_want_for_christmas_is_you',
+              track_prefix='All I Want for Christmas Is You', threshold=1),
+         Rule('deffinitive_halloween_experience',
+              tracks=('Thriller',), artists=('Michael Jackson',), dates=((10, 31), (11, 1)),
+              comparison='>'),
+         Rule('variety_is_the_spice_of_life',
+              top_artists=20, aggregate='share', comparison='<', threshold=0.3),
+         Rule('days_streamed',
+              aggregate='days', comparison='==', threshold='period'))
+
+def _names_mask(names, selected):
+    """Returns a mask of the names (unique) that are on selected, looked up on
+    the hash table of the names index"""
+    mask = np.zeros(len(names), dtype=bool)
+    positions = names.get_indexer(list(selected))
+    mask[positions[positions >= 0]] = True
+    return mask
+
+
+def _prefix_mask(names, prefix):
+    """Returns a mask of the names that start with prefix. Categories are sorted,
+    so they're found with a binary search"""
+    if not names.is_monotonic_increasing:
+        return np.asarray(names.str.startswith(prefix), dtype=bool)
+    mask = np.zeros(len(names), dtype=bool)
+    mask[names.searchsorted(prefix):names.searchsorted(prefix + '\U0010ffff')] = True
+    return mask
+
+
+def evaluate(rules, cube, hours_played, top_artists, period_days):
+    """Evaluates every rule over the cube (see DataManager.cube, sorted by date)
+    and returns a dictionary of {'achieved', 'value'} by rule name.
+
+    hours_played has the hours of every row of the cube, top_artists(n) returns
+    the names of the top n artists and period_days is the amount of days of the
+    period. Every dimension is resolved on its distinct values and the rows of
+    all the rules are matched and aggregated together"""
+    artists = cube.artistName.cat
+    tracks = cube.trackName.cat
+    dates = cube.date.values.astype('datetime64[D]')
+
+    # Rows of the same day are contiguous, starts has the first row of every day
+    new_day = np.ones(len(dates), dtype=bool)
+    new_day[1:] = dates[1:] != dates[:-1]
+    starts = np.flatnonzero(new_day)
+    day_index = np.cumsum(new_day) - 1
+    days = dates[starts]
+
+    months = days.astype('datetime64[M]')
+    month_days = (days - months.astype('datetime64[D]')).astype(np.int64) + 1
+    months = months.astype(np.int64) % 12 + 1
+
+    # The conditions are evaluated over the distinct names and days
+    track_table = np.ones((len(rules), len(tracks.categories)), dtype=bool)
+    artist_table = np.ones((len(rules), len(artists.categories)), dtype=bool)
+    day_table = np.ones((len(rules), len(days)), dtype=bool)
+    for i, rule in enumerate(rules):
+        if rule.aggregate not in ('hours', 'share', 'days'):
+            raise ValueError(f"Unknown aggregate '{rule.aggregate}' on rule '{rule.name}'")
+        if rule.tracks is not None:
+            track_table[i] &= _names_mask(tracks.categories, rule.tracks)
+        if rule.track_prefix is not None:
+            track_table[i] &= _prefix_mask(tracks.categories, rule.track_prefix)
+        if rule.artists is not None:
+            artist_table[i] &= _names_mask(artists.categories, rule.artists)
+        if rule.top_artists is not None:
+            artist_table[i] &= _names_mask(artists.categories, top_artists(rule.top_artists))
+        if rule.dates is not None:
+            day_table[i] = np.logical_or.reduce([(months == month) & (month_days == day)
+                                                 for month, day in rule.dates])
+
+    # rules x rows, every aggregate is computed from it in a single pass
+    matches = track_table[:, tracks.codes] & artist_table[:, artists.codes] & day_table[:, day_index]
+    hours = matches @ hours_played
+    total_hours = hours_played.sum()
+    aggregates = {'hours': hours,
+                  'share': hours / total_hours if total_hours > 0 else np.zeros(len(rules)),
+                  'days': (np.logical_or.reduceat(matches, starts, axis=1).sum(axis=1)
+                           if len(starts) else np.zeros(len(rules), dtype=int))}
+
+    results = {}
+    for i, rule in enumerate(rules):
+        value = aggregates[rule.aggregate][i].item()
+        threshold = period_days if rule.threshold == 'period' else rule.threshold
+        achieved = COMPARISONS[rule.comparison](value, threshold)
+        # An empty period has no days to stream on, so it can't be achieved
+        if rule.threshold == 'period' and period_days == 0:
+            achieved = False
+        results[rule.name] = {'achieved': achieved, 'value': value}
+    return results
@@ -0,0 +1,95 @@
+"""batch module. Generates the reports of many exports on a pool of worker processes
+that load the fonts, the matplotlib style and the static background only once.
+
+Usage: python3 ./batch.py <manifest> <summary> [--workers N]
+
+The manifest is a json list of jobs like
+{"input_dir": "...", "output_path": "...", "timezone": "US/Pacific", "year": 2022},
+timezone and year are optional and default to UTC and data_manager.YEAR, "cache":
+false skips the history cache of the input_dir. The summary is a json list with
+the status and duration of every job, and the error and error_type (the name of
+the exception) of the failed ones."""
+import argparse
+import json
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import plot_generator
+from plot_generator import PlotGenerator
+from spotify_rewrapped import SpotifyRewrapped
+
+# Configured once per worker by init_worker. A PlotGenerator holds the plots of
+# the job being rendered, so every thread of a worker gets its own
+_worker = threading.local()
+
+def init_worker():
+    """Loads the fonts, the style and the static layer of the worker"""
+    _worker.plot_generator = PlotGenerator(style='./resources/spotify.mplstyle',
+                                           font='./resources/gotham-medium.otf')
+    plot_generator.configure(_worker.plot_generator.style, _worker.plot_generator.font)
+    # The static layer is kept by image_generator, the jobs get copies of it
+    SpotifyRewrapped.create_image_generator()
+
+
+def run_job(job):
+    """Generates the report of job and returns its summary"""
+    if getattr(_worker, 'plot_generator', None) is None:
+        init_worker()
+
+    start = time.perf_counter()
+    summary = {'input_dir': job['input_dir'],
+               'output_path': job['output_path'],
+               'timezone': job.get('timezone', 'UTC')}
+    try:
+        SpotifyRewrapped(path=summary['input_dir'],
+                         output=summary['output_path'],
+                         timezone=summary['timezone'],
+                         year=job.get('year'),
+                         cache=job.get('cache', True),
+                         plot_generator=_worker.plot_generator).generate()
+        summary['status'] = 'ok'
+    except Exception as e: # pylint: disable=broad-except
+        summary['status'] = 'error'
+        summary['error'] = f'{type(e).__name__}: {e}'
+        summary['error_type'] = type(e).__name__
+    summary['seconds'] = time.perf_counter() - start
+    return summary
+
+
+def run_batch(jobs, workers=None):
+    """Runs every job on a pool of at most workers processes and returns the
+    summaries in the same order as jobs"""
+    summaries = [None] * len(jobs)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as pool:
+        futures = {pool.submit(run_job, job): i for i, job in enumerate(jobs)}
+        for future in as_completed(futures):
+            summary = future.result()
+            summaries[futures[future]] = summary
+            print(f"[{summary['status']}] {summary['input_dir']} ({summary['seconds']:.2f}s)")
+    return summaries
+
+
+def main():
+    """Entrypoint"""
+    parser = argparse.ArgumentParser(description='Generates the reports of a manifest of jobs')
+    parser.add_argument('manifest', help='json list of input_dir, output_path, timezone jobs')
+    parser.add_argument('summary', help='path where the json summary is written')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='maximum amount of concurrent jobs, defaults to the cpu count')
+    args = parser.parse_args()
+
+    with open(args.manifest, 'r', encoding='utf-8') as f:
+        jobs = json.load(f)
+
+    start = time.perf_counter()
+    summaries = run_batch(jobs, workers=args.workers)
+    with open(args.summary, 'w', encoding='utf-8') as f:
+        json.dump({'seconds': time.perf_counter() - start,
+                   'ok': sum(summary['status'] == 'ok' for summary in summaries),
+                   'error': sum(summary['status'] != 'ok' for summary in summaries),
+                   'jobs': summaries}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,303 @@
+"""benchmark module. Generates synthetic StreamingHistory files and times every stage
+of the pipeline on them.
+
+Usage:
+    python3 ./benchmark.py generate <path> [--rows N] [--artists N] [--tracks N] [--days N]
+    python3 ./benchmark.py run <results.json> [--input <path>] [--rows N] ...
+    python3 ./benchmark.py compare <baseline.json> <results.json> [--threshold 0.2]
+    python3 ./benchmark.py startup [--budget 0.5]
+    python3 ./benchmark.py service [--input <path>] [--jobs 4] [--rows N] ...
+
+run generates a temporary dataset unless --input is given. compare exits with
+status 1 when any stage is slower than the baseline by more than threshold.
+startup exits with status 1 when importing an entry point takes longer than the
+budget or imports any of the heavy dependencies. service exits with status 1 when
+reports rendered concurrently by an in process server.RenderService fail or differ
+from the same reports rendered one at a time."""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from data_manager import DataManager, YEAR
+from history_reader import read_streaming_history
+from history_schemas import find_history_files
+from instrumentation import Tracer, peak_rss_mb
+import plot_generator
+import server
+from spotify_rewrapped import SpotifyRewrapped
+
+RECORDS_PER_FILE = 10000
+
+# Timezones of the reports rendered concurrently by the service command
+SERVICE_TIMEZONES = ['UTC', 'Europe/Madrid', 'US/Pacific', 'Asia/Tokyo',
+                     'Australia/Sydney', 'America/Sao_Paulo', 'Asia/Kolkata', 'Africa/Cairo']
+
+# Entry points checked by the startup command, they must not import HEAVY_MODULES
+# and their import must take less than STARTUP_BUDGET seconds
+ENTRY_POINTS = ['linux', 'spotify_rewrapped_gui']
+HEAVY_MODULES = ['pandas', 'numpy', 'matplotlib', 'PIL']
+STARTUP_BUDGET = 0.5
+
+def generate(path, rows=100000, artists=2000, tracks=20000, days=365, seed=0):
+    """Writes rows synthetic streams as StreamingHistoryN.json files on path. The
+    streams span days days ending at the end of YEAR, artists popularity follows
+    a power law and every track belongs to a random artist"""
+    rng = np.random.default_rng(seed)
+    os.makedirs(path, exist_ok=True)
+    end = datetime.datetime(YEAR + 1, 1, 1)
+    start = end - datetime.timedelta(days=days)
+    span_minutes = days * 24 * 60
+
+    # Popular artists own most of the streams
+    track_artists = (artists * rng.random(tracks) ** 3).astype(np.int64)
+
+    for i, offset in enumerate(range(0, rows, RECORDS_PER_FILE)):
+        size = min(RECORDS_PER_FILE, rows - offset)
+        first_minute = offset * span_minutes // rows
+        last_minute = max(first_minute + 1, (offset + size) * span_minutes // rows)
+        minutes = np.sort(rng.integers(first_minute, last_minute, size))
+        track_ids = (tracks * rng.random(size) ** 2).astype(np.int64)
+        ms_played = rng.integers(0, 300000, size)
+
+        end_times = [(start + datetime.timedelta(minutes=int(minute))).strftime('%Y-%m-%d %H:%M')
+                     for minute in minutes]
+        records = [{'endTime': end_time,
+                    'artistName': f'Artist {track_artists[track]}',
+                    'trackName': f'Track {track}',
+                    'msPlayed': int(ms)}
+                   for end_time, track, ms in zip(end_times, track_ids, ms_played)]
+        with open(os.path.join(path, f'StreamingHistory{i}.json'), 'w', encoding='utf-8') as f:
+            json.dump(records, f, indent=2)
+
+
+def run(path, timezone='UTC'):
+    """Runs every stage of the pipeline on the StreamingHistory files of path and
+    returns the timings by stage"""
+    stages = Tracer()
+    files = find_history_files(path)
+
+    df = stages.call('ingest', read_streaming_history, files)
+    df = stages.call('enrich', DataManager.enrich, df, timezone)
+    dm = DataManager.from_dataframe(df)
+    stages.call('query.cube', lambda: dm.cube)
+    dm = stages.call('query.period', dm.for_year, YEAR)
+    stages.call('query.aggregates', dm.aggregates)
+
+    top = stages.call('query.get_top_n_artists', dm.get_top_n_artists, 20)
+    hour = stages.call('query.get_streamed_hours_by_time_of_day',
+                       dm.get_streamed_hours_by_time_of_day)
+    day_of_the_week = stages.call('query.get_streamed_hours_by_day_of_week',
+                                  dm.get_streamed_hours_by_day_of_week)
+    cumsum = stages.call('query.get_cumsum_by_week', dm.get_cumsum_by_week, 10)
+    hours = stages.call('query.get_percent_hours_played_in_top_artists',
+                        dm.get_percent_hours_played_in_top_artists, 20)
+    stages.call('query.achievements', dm.achievements)
+
+    top_artists = list(dm.get_top_n_artists(10).index)
+    top_artists.reverse()
+    stages.call('plot.configure', plot_generator.configure,
+                './resources/spotify.mplstyle', './resources/gotham-medium.otf')
+    plots = {}
+    for name, args in [('top-artists', (top,)),
+                       ('hourly-plot', (hour,)),
+                       ('day-of-the-week-plot', (day_of_the_week,)),
+                       ('artists-through-the-year', (cumsum, top_artists)),
+                       ('top-20-pie', (hours,))]:
+        plots[name] = stages.call(f'plot.{name}', plot_generator.render, name, *args)
+
+    # The static layer is drawn once per process, the first call is the cold one
+    ig = stages.call('image.static', SpotifyRewrapped.create_image_generator)
+    ig = stages.call('image.static.cached', SpotifyRewrapped.create_image_generator)
+    stages.call('image.compose', ig.paste_plots, plots)
+    with tempfile.TemporaryDirectory() as directory:
+        stages.call('image.save', ig.save, os.path.join(directory, 'spotify-rewrapped.png'))
+
+    results = {}
+    for span in stages.spans:
+        results[span['name']] = {key: span[key] for key in ('seconds', 'cpu_seconds', 'peak_rss_mb')}
+        print(f"{span['name']:<45} {span['seconds']:8.3f}s")
+    return results
+
+
+def startup(module, repeat=5):
+    """Imports module on fresh interpreters and returns the best import and process
+    times, together with the heavy modules that were imported"""
+    code = ('import json, sys, time\n'
+            'start = time.perf_counter()\n'
+            f'import {module}\n'
+            'print(json.dumps({"seconds": time.perf_counter() - start,\n'
+            f'                  "heavy": [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))')
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        result = json.loads(output)
+        result['process_seconds'] = time.perf_counter() - start
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    return best
+
+
+def service(path, jobs=4):
+    """Renders the reports of the dataset on path for jobs timezones at once on a
+    RenderService of jobs threads, then one at a time. Returns the status of every
+    timezone: 'ok', 'differs' or the error of the concurrent render"""
+    from PIL import Image, ImageChops # pylint: disable=import-outside-toplevel
+
+    files = {}
+    for file in find_history_files(path):
+        with open(file, 'rb') as f:
+            files[os.path.basename(file)] = f.read()
+    timezones = (SERVICE_TIMEZONES * jobs)[:jobs]
+
+    render_service = server.RenderService(workers=jobs, executor=ThreadPoolExecutor(jobs))
+    with ThreadPoolExecutor(jobs) as clients:
+        futures = {timezone: clients.submit(render_service.submit, files, timezone)
+                   for timezone in timezones}
+    render_service.shutdown()
+
+    results = {}
+    for timezone, future in futures.items():
+        try:
+            png, _ = future.result()
+        except Exception as e: # pylint: disable=broad-except
+            results[timezone] = f'{type(e).__name__}: {e}'
+            continue
+        expected = server.render_files(files, timezone, None)
+        difference = ImageChops.difference(Image.open(io.BytesIO(png)).convert('RGB'),
+                                           Image.open(io.BytesIO(expected)).convert('RGB'))
+        results[timezone] = 'ok' if difference.getbbox() is None else 'differs'
+    return results
+
+
+def compare(baseline, results, threshold=0.2, min_seconds=0.01):
+    """Returns the stages of results slower than on baseline by more than threshold
+    (a ratio). Stages faster than min_seconds on both are ignored as noise"""
+    regressions = {}
+    for name, stage in results['stages'].items():
+        if name not in baseline['stages']:
+            continue
+        before, after = baseline['stages'][name]['seconds'], stage['seconds']
+        if max(before, after) >= min_seconds and after > before * (1 + threshold):
+            regressions[name] = {'baseline': before, 'seconds': after}
+    return regressions
+
+
+def main():
+    """Entrypoint"""
+    parser = argparse.ArgumentParser(description='Spotify rewrapped benchmarks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    dataset = argparse.ArgumentParser(add_help=False)
+    dataset.add_argument('--rows', type=int, default=100000)
+    dataset.add_argument('--artists', type=int, default=2000)
+    dataset.add_argument('--tracks', type=int, default=20000)
+    dataset.add_argument('--days', type=int, default=365)
+    dataset.add_argument('--seed', type=int, default=0)
+
+    generate_parser = subparsers.add_parser('generate', parents=[dataset],
+                                            help='writes a synthetic dataset')
+    generate_parser.add_argument('path')
+
+    run_parser = subparsers.add_parser('run', parents=[dataset], help='times every stage')
+    run_parser.add_argument('results', help='path where the json results are written')
+    run_parser.add_argument('--input', help='existing dataset, a synthetic one is used otherwise')
+    run_parser.add_argument('--timezone', default='UTC')
+
+    compare_parser = subparsers.add_parser('compare', help='flags regressions against a baseline')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('results')
+    compare_parser.add_argument('--threshold', type=float, default=0.2)
+
+    startup_parser = subparsers.add_parser('startup', help='checks the entry points import time')
+    startup_parser.add_argument('--budget', type=float, default=STARTUP_BUDGET,
+                                help='maximum import time in seconds')
+    startup_parser.add_argument('--results', help='path where the json results are written')
+
+    service_parser = subparsers.add_parser('service', parents=[dataset],
+                                           help='checks concurrent renders of the server')
+    service_parser.add_argument('--input', help='existing dataset, a synthetic one is used otherwise')
+    service_parser.add_argument('--jobs', type=int, default=4,
+                                help='amount of reports rendered at once')
+
+    args = parser.parse_args()
+    dataset_args = {}
+    if args.command in ('generate', 'run', 'service'):
+        dataset_args = {'rows': args.rows, 'artists': args.artists, 'tracks': args.tracks,
+                        'days': args.days, 'seed': args.seed}
+
+    if args.command == 'generate':
+        generate(args.path, **dataset_args)
+
+    elif args.command == 'run':
+        if args.input is None:
+            with tempfile.TemporaryDirectory() as path:
+                generate(path, **dataset_args)
+                stages = run(path, timezone=args.timezone)
+        else:
+            dataset_args = {'input': args.input}
+            stages = run(args.input, timezone=args.timezone)
+
+        with open(args.results, 'w', encoding='utf-8') as f:
+            json.dump({'dataset': dataset_args,
+                       'timezone': args.timezone,
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'peak_rss_mb': peak_rss_mb(),
+                       'stages': stages}, f, indent=2)
+
+    elif args.command == 'compare':
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        with open(args.results, 'r', encoding='utf-8') as f:
+            results = json.load(f)
+        regressions = compare(baseline, results, threshold=args.threshold)
+        for name, regression in regressions.items():
+            print(f"REGRESSION {name}: {regression['baseline']:.3f}s -> {regression['seconds']:.3f}s")
+        if regressions:
+            sys.exit(1)
+        print('No regressions found')
+
+    elif args.command == 'startup':
+        results = {module: startup(module) for module in ENTRY_POINTS}
+        failed = False
+        for module, result in results.items():
+            status = 'ok'
+            if result['seconds'] > args.budget or result['heavy']:
+                status = 'OVER BUDGET'
+                failed = True
+            print(f"{module:<25} {result['seconds']:6.3f}s import, "
+                  f"{result['process_seconds']:6.3f}s process, "
+                  f"heavy modules: {result['heavy'] or 'none'} [{status}]")
+        if args.results is not None:
+            with open(args.results, 'w', encoding='utf-8') as f:
+                json.dump({'budget': args.budget, 'entry_points': results}, f, indent=2)
+        if failed:
+            sys.exit(1)
+
+    elif args.command == 'service':
+        if args.input is None:
+            with tempfile.TemporaryDirectory() as path:
+                generate(path, **dataset_args)
+                results = service(path, jobs=args.jobs)
+        else:
+            results = service(args.input, jobs=args.jobs)
+        for timezone, status in results.items():
+            print(f'{timezone:<25} [{status}]')
+        if any(status != 'ok' for status in results.values()):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
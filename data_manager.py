@@ -1,130 +1,443 @@
 """data_manager module. Contains the needed code to store the input data and query it"""
+import copy
+import functools
+
 import numpy as np
 import pandas as pd
 
+import achievements
+from history_reader import COLUMNS, read_streaming_history
+
+# Default year of the reports
+YEAR = 2022
+MS_PER_HOUR = 60 * 60 * 1000
+
+# Supported get_cumsum_by buckets, maps each one to a function that returns the
+# first day of the bucket of every day (datetime64[D]). Weeks are ISO weeks, so
+# they start on Monday and a year can have 52 or 53 of them
+BUCKETS = {'day': lambda days: days,
+           'week': lambda days: days - ((days.astype(np.int64) + 3) % 7).astype('timedelta64[D]'),
+           'month': lambda days: days.astype('datetime64[M]').astype('datetime64[D]')}
+
+# The cube is grouped by date first, so its rows are sorted by date
+CUBE_KEYS = ['date', 'hour', 'artistName', 'trackName']
+
+# Timezone offsets are looked up by bucket of UTC time, the transitions of every
+# timezone happen at the start of one
+OFFSET_BUCKET = 15 * 60
+
+# Part of the day of every hour, as codes of PARTS_OF_THE_DAY
+PARTS_OF_THE_DAY = ['Afternoon', 'Evening', 'Morning', 'Night']
+HOUR_PARTS = np.array([3] * 6 + [2] * 7 + [0] * 5 + [1] * 4 + [3] * 2, dtype=np.int8)
+
+def utc_offsets(seconds, timezone):
+    """Returns the offset of timezone, in seconds, at every time of seconds (UTC
+    epoch seconds). The offsets are computed once per OFFSET_BUCKET of the span
+    of seconds and looked up"""
+    if len(seconds) == 0:
+        return np.zeros(0, dtype=np.int64)
+    buckets = seconds // OFFSET_BUCKET
+    first = buckets.min()
+    grid = pd.date_range(pd.Timestamp(first * OFFSET_BUCKET, unit='s', tz='UTC'),
+                         periods=buckets.max() - first + 1, freq=f'{OFFSET_BUCKET}s')
+    offsets = (grid.tz_convert(timezone).tz_localize(None) - grid.tz_localize(None)) \
+                // pd.Timedelta(seconds=1)
+    return np.asarray(offsets, dtype=np.int64)[buckets - first]
+
+
+def calendar(days, hour):
+    """Returns the calendar columns of the days since epoch and hours of the day
+    (local time). Every column is computed from the integers with numpy"""
+    dates = days.astype('datetime64[D]')
+    day_of_week = (days + 3) % 7
+    # The ISO week is the week of the year of its Thursday
+    thursdays = days - day_of_week + 3
+    first_days = thursdays.astype('datetime64[D]').astype('datetime64[Y]').astype('datetime64[D]')
+    week = (thursdays - first_days.astype(np.int64)) // 7 + 1
+    return {'date': dates,
+            'month': (dates.astype('datetime64[M]').astype(np.int64) % 12 + 1).astype(np.int8),
+            'week': week.astype(np.int8),
+            'day_of_week': day_of_week.astype(np.int8),
+            'hour': hour.astype(np.int8),
+            'part_of_the_day': pd.Categorical.from_codes(HOUR_PARTS[hour], PARTS_OF_THE_DAY)}
+
+def memoize(method):
+    """Caches the result of a DataManager query by its arguments. The cached
+    result is shared between calls, so it shouldn't be modified"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        key = (method.__name__, args, tuple(sorted(kwargs.items())))
+        if key not in self._memo:
+            self._memo[key] = method(self, *args, **kwargs)
+        return self._memo[key]
+    return wrapper
+
 class DataManager:
-    """It's main responsability is to store the input data and allow querying it"""
-    def __init__(self, files=None, timezone='UTC'):
-        # Read input files
-        self.df = pd.DataFrame()
-        for file in files:
-            print(f"Matched input file {file}")
-            data_frame = pd.read_json(file)
-            self.df = pd.concat([self.df, data_frame], axis=0)
-
-        # Filter and process data
-        self.df.endTime = pd.to_datetime(self.df.endTime).dt.tz_localize('UTC').dt.tz_convert(timezone)
-        self.df = self.df[self.df.endTime.dt.year == 2022]
-        self.df = self.df[self.df.msPlayed > 10000]
-
-        # Add new columns
-        self.df['date'] = self.df.endTime.dt.date
-        self.df['month'] = self.df.endTime.dt.month
-        self.df['week'] = self.df.endTime.dt.isocalendar().week
-        self.df['day_of_week'] = self.df.endTime.dt.dayofweek
-        self.df['hour'] = self.df.endTime.dt.hour
-        self.df['part_of_the_day'] = pd.cut(self.df.hour,
-                                            bins=[-1, 5, 12, 17, 21, 23],
-                                            labels=['Night', 'Morning', 'Afternoon',
-                                                    'Evening', 'Night'],
-                                            ordered=False)
-        self.df['hours_played'] = self.df.msPlayed / (60 * 60 * 1000)
+    """It's main responsability is to store the input data and allow querying it.
+
+    The whole history is kept sorted by date. The queries are answered for the
+    period selected with between or for_year, the whole history by default.
+
+    With an IncrementalStore only the cube is kept: the files that were already
+    ingested on a previous run aren't read again and the streams aren't held
+    in memory, so df is None"""
+    def __init__(self, files=None, timezone='UTC', cache=None, incremental=None):
+        self._memo = {}
+        self._cube = None
+        self.timezone = timezone
+        self.start = None
+        self.end = None
+        if not files:
+            raise ValueError('There are no streaming history files to read')
+        if incremental is not None:
+            self.df = None
+            self._cube = incremental.update(files, timezone)
+            return
+
+        self.df = cache.load(files, timezone) if cache is not None else None
+        if self.df is None:
+            self.df = self.read_history(files, timezone)
+            if cache is not None:
+                cache.store(self.df, files)
+
+    @classmethod
+    def from_dataframe(cls, df):
+        """Returns a DataManager over a DataFrame already enriched by enrich"""
+        data_manager = cls.__new__(cls)
+        data_manager._memo = {}
+        data_manager._cube = None
+        data_manager.timezone = str(df.endTime.dt.tz)
+        data_manager.start = None
+        data_manager.end = None
+        data_manager.df = df
+        return data_manager
+
+    def between(self, start=None, end=None):
+        """Returns a DataManager that answers the queries for the streams from
+        start (included) to end (excluded). Both are dates on the timezone of the
+        streams, None means from the first or up to the last stream.
+
+        Nothing is read again: the streams and the cube are shared with this
+        DataManager and sliced with a binary search on their sorted dates"""
+        start = None if start is None else pd.Timestamp(start).normalize().to_datetime64()
+        end = None if end is None else pd.Timestamp(end).normalize().to_datetime64()
+
+        data_manager = copy.copy(self)
+        data_manager._memo = {}
+        data_manager.start = start
+        data_manager.end = end
+        data_manager._cube = self._slice(self.cube, start, end)
+        if self.df is not None:
+            data_manager.df = self._slice(self.df, start, end)
+        return data_manager
+
+    def in_timezone(self, timezone):
+        """Returns a DataManager over the same streams converted to timezone, so a
+        single read of the history can feed reports on several timezones. The
+        selected period isn't kept"""
+        if self.df is None:
+            raise ValueError('The streams are not kept with an IncrementalStore, '
+                             'the history has to be read on the new timezone')
+        return DataManager.from_dataframe(self.enrich(self.df[COLUMNS], timezone))
+
+    def for_year(self, year):
+        """Returns a DataManager that answers the queries for the streams of year"""
+        return self.between(f'{year}-01-01', f'{year + 1}-01-01')
+
+    @staticmethod
+    def _slice(rows, start, end):
+        """Returns the rows, sorted by date, from start to end"""
+        dates = rows.date.values
+        first = 0 if start is None else dates.searchsorted(start)
+        last = len(dates) if end is None else dates.searchsorted(end)
+        return rows.iloc[first:last]
+
+    def period(self):
+        """Returns the first day of the period and the day after its last one, as
+        datetime64[D]. The unbounded sides are taken from the streams"""
+        dates = self.aggregates()['date'].index.values.astype('datetime64[D]')
+        # An empty unbounded history has an empty period
+        start = dates[0] if len(dates) else np.datetime64(0, 'D')
+        end = dates[-1] + 1 if len(dates) else start
+        if self.start is not None:
+            start = self.start.astype('datetime64[D]')
+        if self.end is not None:
+            end = self.end.astype('datetime64[D]')
+        return start, end
+
+    def period_days(self):
+        """Returns the amount of days of the period"""
+        start, end = self.period()
+        return int((end - start) // np.timedelta64(1, 'D'))
+
+    @staticmethod
+    def read_history(files, timezone):
+        """Reads the input files and returns them as an enriched DataFrame"""
+        # Read input files, msPlayed is filtered while reading
+        df = read_streaming_history(files, min_ms_played=10000)
+        return DataManager.enrich(df, timezone)
+
+    @staticmethod
+    def enrich(df, timezone):
+        """Converts the streams read by read_streaming_history to timezone, sorts
+        them by time and adds the calendar columns. endTime can be naive UTC or
+        on any timezone"""
+        # .values is UTC in both cases, the local time is computed on epoch seconds
+        order = np.argsort(df.endTime.values, kind='stable')
+        df = df.iloc[order].reset_index(drop=True)
+        utc = df.endTime.values
+        seconds = utc.astype('datetime64[s]').astype(np.int64)
+        days, local_seconds = np.divmod(seconds + utc_offsets(seconds, timezone), 24 * 60 * 60)
 
+        df['endTime'] = pd.Series(utc).dt.tz_localize('UTC').dt.tz_convert(timezone)
+
+        # Store artists and tracks as integer codes over a dictionary of names
+        df['artistName'] = df.artistName.astype('category')
+        df['trackName'] = df.trackName.astype('category')
+        df['msPlayed'] = df.msPlayed.astype(np.int32)
+
+        # Add new columns, hours_played is derived from msPlayed when querying
+        columns = calendar(days, local_seconds // (60 * 60))
+        columns['date'] = columns['date'].astype(utc.dtype)
+        for column, values in columns.items():
+            df[column] = values
+        return df
+
+    @property
+    def cube(self):
+        """Returns the msPlayed aggregated by date, hour, artist and track, computed
+        on a single pass over the streams and sorted by date. It also has the
+        day_of_week, week and part_of_the_day of its rows.
+
+        The cube is what periods are sliced from and what the track rules of the
+        achievements are evaluated on, the other queries are answered from the
+        small tables of aggregates"""
+        if self._cube is None:
+            self._cube = self.build_cube(self.df)
+        return self._cube
+
+    @staticmethod
+    def build_cube(rows):
+        """Aggregates the msPlayed of rows by CUBE_KEYS. rows can be streams or
+        other cubes, so cubes can be merged by building a cube of them"""
+        # msPlayed may be int32, sum on int64 so that the totals can't overflow
+        cube = rows.msPlayed.astype(np.int64)\
+                    .groupby([rows[key] for key in CUBE_KEYS], observed=True)\
+                    .sum()\
+                    .reset_index()
+
+        cube['artistName'] = cube.artistName.astype('category')
+        cube['trackName'] = cube.trackName.astype('category')
+        return DataManager.add_cube_calendar(cube)
+
+    @staticmethod
+    def add_cube_calendar(cube):
+        """Adds the day_of_week, week and part_of_the_day of its rows to a cube that
+        only has the CUBE_KEYS and msPlayed columns, and returns it"""
+        columns = calendar(cube.date.values.astype('datetime64[D]').astype(np.int64),
+                           cube.hour.values.astype(np.int64))
+        for column in ['day_of_week', 'week', 'part_of_the_day']:
+            cube[column] = columns[column]
+        return cube
+
+    @memoize
+    def aggregates(self):
+        """Returns the msPlayed of the period by artist, hour, (part_of_the_day,
+        day_of_week), date and (artist code, first day of the ISO week). They're
+        computed together from the columns of the cube, with counting sorts
+        instead of groupbys, and every query is answered from them"""
+        cube = self.cube
+        # float64 sums of integer msPlayed are exact, they're cast back to int64
+        weights = cube.msPlayed.values.astype(np.float64)
+
+        def ms_by(codes, labels):
+            """Returns the msPlayed by the codes of labels that have any row"""
+            rows = np.bincount(codes, minlength=len(labels))
+            ms_played = np.bincount(codes, weights, minlength=len(labels)).astype(np.int64)
+            return pd.Series(ms_played, index=labels)[rows > 0]
+
+        artists = cube.artistName.cat
+        hours = np.arange(24, dtype=np.int8)
+        parts = cube.part_of_the_day.cat
+        part_days = pd.MultiIndex.from_product([parts.categories, np.arange(7, dtype=np.int8)],
+                                               names=['part_of_the_day', 'day_of_week'])
+        grid = pd.MultiIndex.from_product([PARTS_OF_THE_DAY, np.arange(7, dtype=np.int8)],
+                                          names=['part_of_the_day', 'day_of_week'])
+
+        # Rows of the same day are contiguous, starts has the first row of every day
+        dates = cube.date.values
+        new_day = np.ones(len(dates), dtype=bool)
+        new_day[1:] = dates[1:] != dates[:-1]
+        starts = np.flatnonzero(new_day)
+
+        return {'artist': ms_by(artists.codes.values,
+                                artists.categories.astype(object).rename('artistName')),
+                'hour': ms_by(cube.hour.values, pd.Index(hours, name='hour')),
+                'part_day_of_week': pd.Series(np.bincount(parts.codes.values * 7 + cube.day_of_week.values,
+                                                          weights, minlength=len(part_days))
+                                              .astype(np.int64), index=part_days)
+                                      .reindex(grid, fill_value=0),
+                'date': pd.Series(np.add.reduceat(cube.msPlayed.values.astype(np.int64), starts)
+                                  if len(starts) else np.zeros(0, dtype=np.int64),
+                                  index=pd.Index(dates[starts], name='date')),
+                'week': self.ms_by_artist_and_bucket(cube, 'week')}
+
+    @staticmethod
+    def ms_by_artist_and_bucket(cube, bucket):
+        """Returns the msPlayed of cube by artist code and bucket (see BUCKETS) on
+        the artist, bucket (its first day as days since epoch) and msPlayed columns"""
+        artists = len(cube.artistName.cat.categories)
+        days = BUCKETS[bucket](cube.date.values.astype('datetime64[D]')).astype(np.int64)
+        # Every (bucket, artist) pair is numbered by a hash table and counted
+        pairs, keys = pd.factorize(days * artists + cube.artistName.cat.codes.values)
+        ms_played = np.bincount(pairs, cube.msPlayed.values.astype(np.float64), len(keys))
+        return pd.DataFrame({'artist': keys % max(artists, 1),
+                             'bucket': keys // max(artists, 1),
+                             'msPlayed': ms_played.astype(np.int64)})
+
+    @memoize
+    def _hours_by_artist(self):
+        """Returns the hours_played of every artist sorted ascending"""
+        hours = (self.aggregates()['artist'] / MS_PER_HOUR).to_frame('hours_played')
+        return hours.sort_values(by=['hours_played'], ascending=True)
+
+    def memory_report(self):
+        """Returns the bytes used by each column. before is the size of the column
+        stored as python objects and int64/float64, after is the current size"""
+        report = {}
+        for column in self.df.columns:
+            series = self.df[column]
+            after = series.memory_usage(index=False, deep=True)
+            if column in ('artistName', 'trackName'):
+                before = series.astype(object).memory_usage(index=False, deep=True)
+            elif column == 'date':
+                before = series.dt.date.memory_usage(index=False, deep=True)
+            elif pd.api.types.is_integer_dtype(series.dtype):
+                before = len(series) * np.dtype(np.int64).itemsize
+            else:
+                before = after
+            report[column] = (before, after)
+        report['hours_played'] = (len(self.df) * np.dtype(np.float64).itemsize, 0)
+
+        report = pd.DataFrame.from_dict(report, orient='index', columns=['before', 'after'])
+        report.loc['total'] = report.sum()
+        return report
+
+    @memoize
     def get_top_n_artists(self, n):
         """Returns a list of artist-streamed_hours of your top N streamed artists"""
-        return self.df.groupby('artistName')\
-                    .agg({'hours_played': np.sum})\
-                    .sort_values(by=['hours_played'], ascending=True)\
-                    .tail(n)
+        return self._hours_by_artist().tail(n)
 
+    @memoize
     def get_streamed_hours_by_time_of_day(self):
         """Returns a list of time_of_the_day-hours_played"""
-        return self.df.groupby('hour').agg({'hours_played': np.sum})
+        return (self.aggregates()['hour'] / MS_PER_HOUR).to_frame('hours_played')
 
+    @memoize
     def get_streamed_hours_by_day_of_week(self):
         """Returns a list of streamed hours by day of the week. The indexes are
-        part_of_the_day and day_of_the_week"""
-        day_of_week = self.df.groupby(['part_of_the_day', 'day_of_week'])\
-                            .agg({'hours_played': np.sum})
+        part_of_the_day and day_of_the_week, every part of the day has the 7 days
+        also if there are no streams on them"""
+        day_of_week = (self.aggregates()['part_day_of_week'] / MS_PER_HOUR).to_frame('hours_played')
 
         return {'morning': day_of_week.loc['Morning'],
                 'afternoon': day_of_week.loc['Afternoon'],
                 'evening': day_of_week.loc['Evening'],
                 'night': day_of_week.loc['Night']}
 
+    @memoize
     def get_percent_hours_played_in_top_artists(self, n):
         """Returns [top_hours, non_top_hours] being top_hours the hours that you
         streamed your N top streamed artists and non_top_hours the hours that you
         streamed the rest of the artists"""
-        artists = list(self.get_top_n_artists(n).index)
-        total_hours = self.df.hours_played.sum()
-        top_hours = self.df[self.df.artistName.isin(artists)].hours_played.sum()
+        total_hours = self._hours_by_artist().hours_played.sum()
+        top_hours = self.get_top_n_artists(n).hours_played.sum()
 
         return [top_hours, total_hours - top_hours]
 
     def get_cumsum_by_week(self, n):
         """Returns the cumsum of your top N streamed artists. Index is artistName,
-        each artist has 52 rows, one for each week of the year"""
+        each artist has one row for each ISO week of the period"""
+        return self.get_cumsum_by(n, bucket='week')
+
+    @memoize
+    def get_cumsum_by(self, n, bucket='week'):
+        """Returns the cumsum of your top N streamed artists grouped by bucket,
+        which can be 'day', 'week' or 'month'. Index is artistName, each artist
+        has one row for each bucket of the period, the bucket column is named
+        after the bucket and holds the first day of the bucket"""
+        if bucket not in BUCKETS:
+            raise ValueError(f"Unknown bucket '{bucket}', expected one of {list(BUCKETS)}")
+        first_day = BUCKETS[bucket]
         top_artists = self.get_top_n_artists(n)
 
-        df2 = self.df[self.df.artistName.isin(top_artists.index)]
-        hours_by_week = pd.DataFrame(columns=['week', 'artist_name', 'hours_played'])
-        for i in range(1,53):
-            # Join all weekly streams into one by artist
-            data = df2[df2.week == i].groupby('artistName')\
-                                    .agg({'hours_played': np.sum})
-            week_df = pd.DataFrame({'artist_name': data.index,
-                                    'week': i,
-                                    'hours_played': data.hours_played})
-            hours_by_week = hours_by_week.append(week_df)
-
-        # Fill missing weeks
-        for artist in list(top_artists.index):
-            if hours_by_week[hours_by_week.artist_name == artist].shape[0] < 52:
-                for w in range(1, 53):
-                    if not hours_by_week[(hours_by_week.artist_name == artist) &
-                                         (hours_by_week.week == w)].all(1).any():
-                        hours_by_week = hours_by_week.append({'artist_name': artist,
-                                                              'week': w,
-                                                              'hours_played': 0},
-                                                             ignore_index=True)
-
-        hours_by_week = hours_by_week.set_index('artist_name')\
-                                    .sort_values(by=['artist_name', 'week'])\
-                                    .groupby('artist_name')\
-                                    .cumsum()
-
-        return hours_by_week
+        # Every bucket of the period, also the ones without streams
+        start, end = self.period()
+        buckets = np.unique(first_day(np.arange(start, end, dtype='datetime64[D]')))
+        buckets = buckets.astype('datetime64[ns]')
+
+        # The (artist, bucket) aggregate of the top artists on a dense grid
+        ms_played = (self.aggregates()['week'] if bucket == 'week'
+                     else self._ms_by_artist_and_bucket(bucket))
+        names = sorted(top_artists.index)
+        rows = np.full(len(self.cube.artistName.cat.categories), -1)
+        rows[self.cube.artistName.cat.categories.get_indexer(names)] = np.arange(len(names))
+        ms_played = ms_played[rows[ms_played.artist.values] >= 0]
+        hours = np.zeros((len(names), len(buckets)))
+        hours[rows[ms_played.artist.values],
+              np.searchsorted(buckets.astype('datetime64[D]').astype(np.int64),
+                              ms_played.bucket.values)] = ms_played.msPlayed.values / MS_PER_HOUR
+
+        hours_by_bucket = pd.DataFrame({'artist_name': np.repeat(np.array(names, dtype=object),
+                                                                 len(buckets)),
+                                        bucket: np.tile(buckets, len(names)),
+                                        'hours_played': hours.cumsum(axis=1).ravel()})
+
+        return hours_by_bucket.set_index('artist_name')
+
+    @memoize
+    def _ms_by_artist_and_bucket(self, bucket):
+        """Returns ms_by_artist_and_bucket of the cube, for buckets other than week"""
+        return self.ms_by_artist_and_bucket(self.cube, bucket)
+
+    def achievements(self, rules=None):
+        """Returns the result of every rule of rules, a sequence of
+        achievements.Rule that defaults to achievements.RULES, see
+        achievements.evaluate. They're evaluated together on a single pass over
+        the cube"""
+        return self._achievements(achievements.RULES if rules is None else tuple(rules))
+
+    @memoize
+    def _achievements(self, rules):
+        """Returns achievements of the tuple of rules"""
+        cube = self.cube
+        return achievements.evaluate(rules,
+                                     cube, cube.msPlayed.values / MS_PER_HOUR,
+                                     top_artists=lambda n: self.get_top_n_artists(n).index,
+                                     period_days=self.period_days())
 
     def all_i_want_for_christmas_is_you(self):
         """Checks if you streamed at least 1 hour of All I Want for Christmas Is You,
         returns the ammount of hours and True/False on a dictionary"""
-        data = self.df[(self.df.trackName.str.startswith('All I Want for Christmas Is You'))]
-        hours = 0
-        if data.shape[0] > 0:
-            hours = data.groupby('trackName')\
-                        .agg({'hours_played': np.sum})\
-                        .hours_played[0]
-        return {'achieved': hours >= 1,
-                'hours': hours}
+        achievement = self.achievements()['all_i_want_for_christmas_is_you']
+        return {'achieved': achievement['achieved'],
+                'hours': achievement['value']}
 
     def deffinitive_halloween_experience(self):
-        """Checks if you streamed Thriller on 31/10/2022 or 1/11/2022,
-        returns True/False"""
-        return self.df[(self.df.trackName == 'Thriller') &
-                       (self.df.artistName == 'Michael Jackson') &
-                       ((self.df.endTime.dt.month == 10) & (self.df.endTime.dt.day == 31) |
-                        (self.df.endTime.dt.month == 11) & (self.df.endTime.dt.day == 1))].shape[0] > 0
+        """Checks if you streamed Thriller on 31/10 or 1/11 of any year of the
+        period, returns True/False"""
+        return self.achievements()['deffinitive_halloween_experience']['achieved']
 
     def days_streamed(self):
-        """Checks if you streamed at least 1 track each day of 2022,
-        returns the ammount of days that you streamed and True/False on a dictionary"""
-        days = self.df.groupby('date').size().size
-        return {'achieved': days == 365,
-                'days': days}
+        """Checks if you streamed at least 1 track each day of the period, returns
+        the ammount of days that you streamed, the days of the period and
+        True/False on a dictionary"""
+        achievement = self.achievements()['days_streamed']
+        return {'achieved': achievement['achieved'],
+                'days': achievement['value'],
+                'total': self.period_days()}
 
     def variety_is_the_spice_of_life(self):
         """Checks if your hours streaming your top 20 artists are less or equal
         that 0.3 compared to the total streamed hours"""
-        top_hours, others_hours = self.get_percent_hours_played_in_top_artists(20)
-        return top_hours / (top_hours + others_hours) < 0.3
+        return self.achievements()['variety_is_the_spice_of_life']['achieved']
@@ -0,0 +1,344 @@
+"""history_cache module. Contains the HistoryCache class which stores the parsed and
+enriched history on disk so that it doesn't need to be parsed again"""
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from data_manager import CUBE_KEYS, DataManager
+from history_reader import COLUMNS, read_files
+
+CACHE_DIR = '.spotify-rewrapped-cache'
+CACHE_VERSION = 6
+
+class HistoryCache:
+    """Stores the history read on UTC as one memory-mappable .npy file per
+    column, next to the input files. Categorical columns store their codes that
+    way and their categories as a json list. The cache is keyed on the input
+    files paths, sizes and mtimes, it's only invalidated when any of them
+    changes. Histories on other timezones are converted from it, so they share
+    the cache.
+
+    Loaded columns are memory maps of the files instead of copies, so a file is
+    never written again once the manifest points to it: every store writes a
+    new generation folder and then switches the manifest to it atomically"""
+    def __init__(self, path):
+        self.path = os.path.join(path, CACHE_DIR)
+        self.manifest = os.path.join(self.path, 'manifest.json')
+        self.generations = os.path.join(self.path, 'generations')
+
+    @staticmethod
+    def key(files):
+        """Returns the key that identifies the history read from files"""
+        stats = []
+        for file in files:
+            stat = os.stat(file)
+            stats.append([os.path.abspath(file), stat.st_size, stat.st_mtime_ns])
+        return {'version': CACHE_VERSION, 'files': stats}
+
+    def load(self, files, timezone):
+        """Returns the cached DataFrame converted to timezone, None if there is no
+        valid cache for the specified files"""
+        try:
+            manifest = self._read_manifest()
+            if manifest['key'] != self.key(files):
+                return None
+            columns = {column: self._load_column(manifest['generation'], column, kind)
+                       for column, kind in manifest['columns'].items()}
+        except (OSError, ValueError, KeyError):
+            return None
+
+        print(f"Loaded cached history from {self.path}")
+        df = pd.DataFrame(columns, copy=False)
+        if timezone != 'UTC':
+            df = DataManager.enrich(df[COLUMNS], timezone)
+        return df
+
+    def store(self, df, files):
+        """Stores df, on any timezone, on the cache. A cache that can't be written
+        (for example on read only inputs) is silently skipped"""
+        if str(df.endTime.dt.tz) != 'UTC':
+            df = DataManager.enrich(df[COLUMNS], 'UTC')
+        try:
+            generation = self._new_generation()
+            columns = {column: self._store_column(generation, column, df[column])
+                       for column in df.columns}
+            self._switch({'key': self.key(files), 'generation': generation, 'columns': columns},
+                         {generation})
+        except OSError as e:
+            print(f"Could not write the history cache: {e}")
+
+    def _read_manifest(self):
+        """Returns the current manifest"""
+        with open(self.manifest, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _new_generation(self):
+        """Creates an empty generation folder and returns its name"""
+        os.makedirs(self.generations, exist_ok=True)
+        return os.path.basename(tempfile.mkdtemp(dir=self.generations))
+
+    def _switch(self, manifest, generations):
+        """Replaces the manifest with manifest at once and removes the generation
+        folders other than generations, the ones it uses. Files of the removed
+        folders that are still mapped stay readable until they're unmapped"""
+        descriptor, temporary = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(descriptor, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        os.replace(temporary, self.manifest)
+
+        for generation in os.listdir(self.generations):
+            if generation not in generations:
+                shutil.rmtree(os.path.join(self.generations, generation), ignore_errors=True)
+
+    def _file(self, generation, column, suffix='', extension='npy'):
+        """Returns the path of the file of generation that stores column"""
+        return os.path.join(self.generations, generation, f'{column}{suffix}.{extension}')
+
+    def _store_column(self, generation, column, series):
+        """Writes series on generation and returns the kind of column that was
+        stored, needed to restore it"""
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            np.save(self._file(generation, column, '.codes'), series.cat.codes.values)
+            # A fixed width array would take the length of the longest name for each one
+            with open(self._file(generation, column, '.categories', 'json'), 'w',
+                      encoding='utf-8') as f:
+                json.dump(series.cat.categories.tolist(), f)
+            return {'type': 'category', 'ordered': bool(series.cat.ordered)}
+
+        if isinstance(series.dtype, pd.DatetimeTZDtype):
+            utc = series.dt.tz_convert('UTC').dt.tz_localize(None)
+            np.save(self._file(generation, column), utc.values)
+            return {'type': 'datetimetz', 'tz': str(series.dt.tz)}
+
+        np.save(self._file(generation, column), series.values)
+        return {'type': 'array'}
+
+    def _load_column(self, generation, column, kind):
+        """Memory maps the column stored by _store_column"""
+        if kind['type'] == 'category':
+            codes = np.load(self._file(generation, column, '.codes'), mmap_mode='r')
+            with open(self._file(generation, column, '.categories', 'json'), 'r',
+                      encoding='utf-8') as f:
+                categories = json.load(f)
+            return pd.Categorical.from_codes(codes, categories, ordered=kind['ordered'])
+
+        values = np.load(self._file(generation, column), mmap_mode='r')
+        if kind['type'] == 'datetimetz':
+            return pd.Series(values).dt.tz_localize('UTC').dt.tz_convert(kind['tz'])
+        return values
+
+
+def stream_keys(df):
+    """Returns a uint64 hash of the (endTime, artistName, trackName) of every stream.
+    endTime has second precision on the extended streaming history"""
+    seconds = (df.endTime - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(seconds=1)
+    keys = pd.DataFrame({'endTime': seconds.values,
+                         'artistName': df.artistName.values,
+                         'trackName': df.trackName.values})
+    return pd.util.hash_pandas_object(keys, index=False).values
+
+
+# Columns stored for every month by IncrementalStore, the names as codes of a
+# dictionary shared by all the months
+MONTH_COLUMNS = CUBE_KEYS + ['msPlayed']
+NAME_COLUMNS = ['artistName', 'trackName']
+
+class IncrementalStore(HistoryCache):
+    """Keeps the cube (see DataManager.cube) of the history ingested on previous
+    runs partitioned by month, together with the sorted keys of the streams of
+    every month. On every update only the new or changed input files are read,
+    their streams that were already ingested (same endTime, artistName and
+    trackName) are skipped and only the months they fall on are aggregated and
+    written again. The other months are memory mapped from their files.
+
+    Artists and tracks are stored as codes of dictionaries of names. New names
+    are appended to them, so the codes of the months that aren't written again
+    stay valid.
+
+    Streams can't be taken out of the cube, so it's built again from scratch
+    when the timezone changes or when an ingested file is removed or shrinks"""
+    def __init__(self, path):
+        super().__init__(path)
+        self.path = os.path.join(self.path, 'incremental')
+        self.manifest = os.path.join(self.path, 'manifest.json')
+        self.generations = os.path.join(self.path, 'generations')
+
+    def update(self, files, timezone):
+        """Folds the new or changed files into the stored cube and returns it"""
+        stats = {}
+        for file in files:
+            stat = os.stat(file)
+            stats[os.path.abspath(file)] = [stat.st_size, stat.st_mtime_ns]
+
+        manifest, names, months = self._load(stats, timezone)
+        ingested = manifest.get('files', {})
+        changed = [file for file in files
+                   if ingested.get(os.path.abspath(file)) != stats[os.path.abspath(file)]]
+        if not changed:
+            print(f"Loaded incremental history from {self.path}")
+            return self._cube(names, months)
+
+        # All the changed files are read at once. A stream repeated on several
+        # files is only taken from the first one, repeated streams within a file
+        # are kept
+        rows = self._read(changed, timezone)
+        row_keys = stream_keys(rows)
+        sources = rows.source.values
+        new = np.ones(len(rows), dtype=bool)
+        if len(changed) > 1:
+            new = sources == pd.Series(sources).groupby(row_keys).transform('min').values
+
+        # The rows of every month, streams are only looked up on the keys of theirs
+        row_months = self._months(rows.date.values)
+        order = np.argsort(row_months, kind='stable')
+        labels, starts = np.unique(row_months[order], return_index=True)
+        ranges = {month: order[start:end]
+                  for month, start, end in zip(labels, starts, list(starts[1:]) + [len(order)])}
+        for month, in_month in ranges.items():
+            label = self._label(month)
+            if label in months:
+                new[in_month] &= ~self._contains(months[label][1], row_keys[in_month])
+        for source, file in enumerate(changed):
+            print(f"Ingested {np.count_nonzero(new & (sources == source))} new streams from {file}")
+
+        added = False
+        for column in NAME_COLUMNS:
+            categories = rows[column].cat.categories
+            missing = categories[names[column].get_indexer(categories) == -1]
+            if len(missing) > 0:
+                names[column] = names[column].append(missing) if len(names[column]) else missing
+                added = True
+
+        new_rows = rows[new][MONTH_COLUMNS]
+        for column in NAME_COLUMNS:
+            new_rows[column] = new_rows[column].cat.set_categories(names[column])
+        cube = DataManager.build_cube(new_rows)[MONTH_COLUMNS]
+        if not months and len(cube) == 0:
+            return DataManager.add_cube_calendar(cube)
+
+        # The cube is sorted by date, so every month is a slice of it
+        cube_months = self._months(cube.date.values)
+        updated = {}
+        for month, in_month in ranges.items():
+            first, last = np.searchsorted(cube_months, [month, month + 1])
+            month_cube = cube.iloc[first:last]
+            if len(month_cube) == 0:
+                continue
+            month_keys = np.unique(row_keys[in_month[new[in_month]]])
+            label = self._label(month)
+            if label in months:
+                columns, keys = months[label]
+                stored = pd.DataFrame({column: (pd.Categorical.from_codes(columns[column],
+                                                                          names[column])
+                                                if column in NAME_COLUMNS else columns[column])
+                                       for column in MONTH_COLUMNS})
+                month_cube = DataManager.build_cube(
+                    pd.concat([stored, month_cube], ignore_index=True))[MONTH_COLUMNS]
+                # Both are sorted, the new keys are inserted instead of sorting again
+                month_keys = np.insert(keys, np.searchsorted(keys, month_keys), month_keys)
+            columns = {column: (month_cube[column].cat.codes.values if column in NAME_COLUMNS
+                                else month_cube[column].values)
+                       for column in MONTH_COLUMNS}
+            months[label] = updated[label] = (columns, month_keys)
+
+        self._store(stats, timezone, manifest, names if added else None, updated)
+        return self._cube(names, months)
+
+    @staticmethod
+    def _read(files, timezone):
+        """Returns the enriched streams of files with the position on files of the
+        file of every stream on the source column"""
+        parts = read_files(files, min_ms_played=10000)
+        rows = pd.concat(parts, ignore_index=True)
+        rows['source'] = np.repeat(np.arange(len(parts)), [len(part) for part in parts])
+        return DataManager.enrich(rows, timezone)
+
+    @staticmethod
+    def _months(dates):
+        """Returns the partition of every date, its month as months since epoch"""
+        return dates.astype('datetime64[M]').astype(np.int64)
+
+    @staticmethod
+    def _label(month):
+        """Returns the name of the partition of a month since epoch, YYYY-MM"""
+        return str(np.datetime64(int(month), 'M'))
+
+    @staticmethod
+    def _cube(names, months):
+        """Returns the cube of the columns of every month. The codes are only
+        renumbered so that the names are sorted, like on DataManager.build_cube"""
+        cube = {column: np.concatenate([months[month][0][column] for month in sorted(months)])
+                for column in MONTH_COLUMNS}
+        for column in NAME_COLUMNS:
+            order = names[column].argsort()
+            codes = np.empty(len(order), dtype=np.int64)
+            codes[order] = np.arange(len(order))
+            cube[column] = pd.Categorical.from_codes(codes[cube[column]], names[column][order])
+        return DataManager.add_cube_calendar(pd.DataFrame(cube, copy=False))
+
+    @staticmethod
+    def _contains(sorted_keys, keys):
+        """Returns a mask of the keys that are present on sorted_keys"""
+        if len(sorted_keys) == 0:
+            return np.zeros(len(keys), dtype=bool)
+        positions = np.searchsorted(sorted_keys, keys).clip(max=len(sorted_keys) - 1)
+        return sorted_keys[positions] == keys
+
+    def _load(self, stats, timezone):
+        """Returns the manifest, the dictionaries of names and the memory mapped
+        (columns, sorted stream keys) of every month of the stored state. If the
+        state can't be updated with stats returns an empty state"""
+        empty = ({}, {column: pd.Index([]) for column in NAME_COLUMNS}, {})
+        try:
+            manifest = self._read_manifest()
+            if manifest['version'] != CACHE_VERSION or manifest['timezone'] != timezone:
+                return empty
+            for file, (size, _) in manifest['files'].items():
+                if file not in stats or stats[file][0] < size:
+                    return empty
+
+            names = {}
+            for column in NAME_COLUMNS:
+                with open(self._file(manifest['names'], column, extension='json'), 'r',
+                          encoding='utf-8') as f:
+                    names[column] = pd.Index(json.load(f))
+            months = {month: ({column: np.load(self._file(generation, f'{month}.{column}'),
+                                               mmap_mode='r')
+                               for column in MONTH_COLUMNS},
+                              np.load(self._file(generation, f'{month}.keys'), mmap_mode='r'))
+                      for month, generation in manifest['months'].items()}
+        except (OSError, ValueError, KeyError):
+            return empty
+        if not months:
+            return empty
+        return manifest, names, months
+
+    def _store(self, stats, timezone, manifest, names, updated):
+        """Writes the (columns, keys) of the updated months, and names when new
+        ones were added, on a new generation. The other months keep the files of
+        their generation. Skipped if it can't be written"""
+        try:
+            generation = self._new_generation()
+            names_generation = manifest.get('names')
+            if names is not None:
+                for column in NAME_COLUMNS:
+                    with open(self._file(generation, column, extension='json'), 'w',
+                              encoding='utf-8') as f:
+                        json.dump(names[column].tolist(), f)
+                names_generation = generation
+            months = dict(manifest.get('months', {}))
+            for month, (columns, keys) in updated.items():
+                for column, values in columns.items():
+                    np.save(self._file(generation, f'{month}.{column}'), values)
+                np.save(self._file(generation, f'{month}.keys'), keys)
+                months[month] = generation
+
+            self._switch({'version': CACHE_VERSION, 'timezone': timezone, 'files': stats,
+                          'names': names_generation, 'months': months},
+                         {names_generation, *months.values()})
+        except OSError as e:
+            print(f"Could not write the incremental history: {e}")
@@ -0,0 +1,177 @@
+"""history_reader module. Contains the code needed to read the streaming history
+json files of any of the history_schemas formats"""
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import json
+import operator
+import os
+
+import numpy as np
+import pandas as pd
+
+from history_schemas import detect_schema
+
+try:
+    import orjson
+except ImportError: # Optional, the json module is used instead
+    orjson = None
+
+CHUNK_SIZE = 1 << 16
+COLUMNS = ['endTime', 'artistName', 'trackName', 'msPlayed']
+
+# Total size of the files from which they're read in parallel
+PARALLEL_BYTES = 32 << 20
+
+def iter_records(file, chunk_size=CHUNK_SIZE):
+    """Yields one by one the elements of the json array stored on file. Only a
+    chunk of the file and the record being decoded are held in memory"""
+    decoder = json.JSONDecoder()
+    with open(file, 'r', encoding='utf-8') as f:
+        buffer = ''
+        position = 0
+        eof = False
+        started = False
+
+        while True:
+            # Skip whitespaces and separators
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+
+            if position == len(buffer):
+                if eof:
+                    raise ValueError(f'{file}: unexpected end of file')
+                buffer = f.read(chunk_size)
+                position = 0
+                eof = len(buffer) < chunk_size
+                continue
+
+            if not started:
+                if buffer[position] != '[':
+                    raise ValueError(f'{file}: expected a json array')
+                started = True
+                position += 1
+                continue
+
+            if buffer[position] == ']':
+                return
+
+            try:
+                record, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                end = None
+
+            # The record may be truncated at the end of the buffer, read more
+            if end is None or (end == len(buffer) and not eof):
+                if eof:
+                    raise ValueError(f'{file}: invalid json at position {position}')
+                chunk = f.read(chunk_size)
+                eof = len(chunk) < chunk_size
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+
+            position = end
+            yield record
+
+
+def read_file(file, year=None, min_ms_played=10000):
+    """Reads a streaming history file of any of the history_schemas.SCHEMAS and
+    returns its endTime, artistName, trackName and msPlayed columns. Only the
+    fields of the columns are read.
+
+    With orjson the file is decoded at once, which is several times faster but
+    holds every record of the file in memory until the columns are extracted
+    (of every file being read when they're read in parallel). Otherwise the
+    records are decoded and filtered one by one by iter_records and only the
+    fields of the kept records are held"""
+    if orjson is None:
+        return _read_records(iter_records(file), year, min_ms_played)
+
+    with open(file, 'rb') as f:
+        records = orjson.loads(f.read())
+    if not records:
+        return _columns([], [], [], [], end_time_format=None)
+    schema = detect_schema(records[0])
+
+    # Each field is read as a column at C speed, the filters are applied on the
+    # columns instead of record by record
+    end_times, artists, tracks = (np.array(list(map(operator.itemgetter(field), records)), dtype=object)
+                                  for field in (schema.end_time, schema.artist, schema.track))
+    ms_played = np.array(list(map(operator.itemgetter(schema.ms_played), records)), dtype=np.int64)
+    del records
+
+    # Records without track are podcast episodes or unknown content
+    keep = (ms_played > min_ms_played) & (tracks != None) & (artists != None) # pylint: disable=singleton-comparison
+    if year is not None:
+        keep &= (end_times >= f'{year - 1}-12-31') & (end_times < f'{year + 1}-01-02')
+    return _columns(end_times[keep], artists[keep], tracks[keep], ms_played[keep],
+                    schema.end_time_format)
+
+
+def _read_records(records, year, min_ms_played):
+    """Returns the columns of the iterable of records like read_file, filtering
+    them one by one"""
+    records = iter(records)
+    first = next(records, None)
+    if first is None:
+        return _columns([], [], [], [], end_time_format=None)
+    schema = detect_schema(first)
+
+    fields = operator.itemgetter(schema.end_time, schema.artist, schema.track, schema.ms_played)
+    start, end = (f'{year - 1}-12-31', f'{year + 1}-01-02') if year is not None else (None, None)
+    end_times, artists, tracks, ms_played = [], [], [], []
+    for record in itertools.chain([first], records):
+        end_time, artist, track, ms = fields(record)
+        # Records without track are podcast episodes or unknown content
+        if ms <= min_ms_played or track is None or artist is None:
+            continue
+        if year is not None and not start <= end_time < end:
+            continue
+        end_times.append(end_time)
+        artists.append(artist)
+        tracks.append(track)
+        ms_played.append(ms)
+    return _columns(end_times, artists, tracks, ms_played, schema.end_time_format)
+
+
+def _columns(end_times, artists, tracks, ms_played, end_time_format):
+    """Returns the DataFrame of the columns read by read_file"""
+    return pd.DataFrame({'endTime': pd.to_datetime(pd.Series(end_times, dtype=object),
+                                                   format=end_time_format),
+                         'artistName': pd.Series(artists, dtype=object),
+                         'trackName': pd.Series(tracks, dtype=object),
+                         'msPlayed': np.array(ms_played, dtype=np.int64)},
+                        columns=COLUMNS)
+
+
+def read_files(files, year=None, min_ms_played=10000, workers=None):
+    """Reads the streaming history files like read_streaming_history and returns
+    the DataFrame of every file, in the same order.
+
+    When the files add up to PARALLEL_BYTES or more they're read on a pool of
+    workers processes, workers=1 always reads them on this process"""
+    size = sum(os.path.getsize(file) for file in files)
+    if len(files) > 1 and size >= PARALLEL_BYTES and workers != 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(read_file, files, itertools.repeat(year),
+                                 itertools.repeat(min_ms_played)))
+    return [read_file(file, year, min_ms_played) for file in files]
+
+
+def read_streaming_history(files, year=None, min_ms_played=10000, workers=None):
+    """Reads the streaming history files and returns a DataFrame with the endTime,
+    artistName, trackName and msPlayed columns.
+
+    Records shorter than min_ms_played are dropped while reading. When year is
+    given only the records around it are kept. endTime is still in UTC at this
+    point, so the year filter keeps a one day margin on each side which covers
+    any timezone; the exact filter has to be applied once endTime is converted.
+
+    Big histories are read in parallel, see read_files"""
+    for file in files:
+        print(f"Matched input file {file}")
+
+    parts = read_files(files, year, min_ms_played, workers)
+    if not parts:
+        return _columns([], [], [], [], end_time_format=None)
+    return pd.concat(parts, ignore_index=True)
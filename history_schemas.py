@@ -0,0 +1,51 @@
+"""history_schemas module. Describes the formats of the streaming history exports
+and finds their files. It doesn't import pandas, so the GUI can use it"""
+from collections import namedtuple
+import os
+import re
+
+# A streaming history format. pattern matches the name of its files, the other
+# fields are the names of the record fields that hold each column
+Schema = namedtuple('Schema', ['name', 'pattern', 'end_time', 'end_time_format',
+                               'artist', 'track', 'ms_played'])
+
+# By precedence: the extended history contains the account data history, so
+# when both are found only the extended one is read
+SCHEMAS = [Schema('extended',
+                  re.compile(r'(endsong|Streaming_History_Audio)_.*\.json'),
+                  'ts', '%Y-%m-%dT%H:%M:%SZ',
+                  'master_metadata_album_artist_name', 'master_metadata_track_name', 'ms_played'),
+           Schema('account',
+                  re.compile(r'StreamingHistory(_music_)?[0-9]+\.json'),
+                  'endTime', '%Y-%m-%d %H:%M',
+                  'artistName', 'trackName', 'msPlayed')]
+
+def natural_key(file):
+    """Returns a sort key that orders the numbers of file by value, so that
+    StreamingHistory10.json goes after StreamingHistory9.json"""
+    return [int(part) if part.isdigit() else part
+            for part in re.split(r'([0-9]+)', os.path.basename(file))]
+
+
+def select_history_files(files):
+    """Returns the streaming history files of files, of the schema with the most
+    precedence that has any, sorted by natural_key. Files are matched by name"""
+    for schema in SCHEMAS:
+        selected = [file for file in files if schema.pattern.fullmatch(os.path.basename(file))]
+        if selected:
+            return sorted(selected, key=natural_key)
+    return []
+
+
+def find_history_files(path):
+    """Returns the streaming history files on path, see select_history_files"""
+    names = os.listdir(path) if os.path.isdir(path) else []
+    return select_history_files([os.path.join(path, name) for name in names])
+
+
+def detect_schema(record):
+    """Returns the schema of a record of a streaming history file"""
+    for schema in SCHEMAS:
+        if schema.end_time in record:
+            return schema
+    raise ValueError(f'Unknown streaming history record with fields {sorted(record)}')
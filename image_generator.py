@@ -1,31 +1,100 @@
 """This module contains the ImageGenerator class which is responsible of generating the final png"""
+import copy
+import json
+import os
+
 from PIL import Image
 from PIL import ImageFont
 from PIL import ImageDraw
 
+# ImageGenerators with the static layer of a layout template drawn, by template
+# path, mtime and scale. See static_layer
+_static_layers = {}
+
+def static_layer(template, scale=1):
+    """Returns an ImageGenerator with the static elements of the layout template
+    (a json file) already drawn. The static layer is drawn once per template,
+    scale and process, every call returns a copy of it"""
+    key = (os.path.abspath(template), os.stat(template).st_mtime_ns, scale)
+    if key not in _static_layers:
+        with open(template, 'r', encoding='utf-8') as f:
+            layout = json.load(f)
+        _static_layers[key] = ImageGenerator.from_layout(layout, scale=scale)
+    return _static_layers[key].copy()
+
+
 class ImageGenerator:
-    """ImageGenerator. Contains the methods that allow creating the final png"""
-    def __init__(self, size=(1500, 2000)):
+    """ImageGenerator. Contains the methods that allow creating the final png.
+
+    Positions, sizes and font sizes are given in layout units, which are
+    multiplied by scale to get pixels"""
+    def __init__(self, size=(1500, 2000), scale=1):
         self.colors = {'background': (25, 20, 20),
                        'foreground': (29, 185, 84),
                        'light-gray': (83, 83, 83),
                        'white': (255, 255, 255)}
         self.foreground_color = (29, 185, 84)
-        self.W, self.H = size
+        self.scale = scale
+        self.W, self.H = (round(size[0] * scale), round(size[1] * scale))
         self.fonts = {}
+        self.layout = None
         self.background = Image.new('RGB', (self.W, self.H), color = self.colors['background'])
 
+    @classmethod
+    def from_layout(cls, layout, scale=1):
+        """Returns an ImageGenerator with the fonts of layout loaded and its static
+        elements and achievement titles drawn. The data dependent regions are
+        drawn later by paste_plots and show_achievements"""
+        image_generator = cls(size=layout['size'], scale=scale)
+        image_generator.layout = layout
+        for name, font in layout['fonts'].items():
+            image_generator.add_font(name, font['path'], font['size'])
+
+        for element in layout['static']:
+            if element['type'] == 'text':
+                image_generator.write_text(element['text'], element['font'], element['position'],
+                                           horizontal_center=element.get('horizontal_center', False),
+                                           color=image_generator.colors.get(element.get('color')))
+            elif element['type'] == 'image':
+                image_generator.paste_image(element['path'], element['position'])
+            else:
+                raise ValueError(f"Unknown layout element type '{element['type']}', "
+                                 "expected 'text' or 'image'")
+
+        for achievement in layout['achievements'].values():
+            image_generator.write_achievement_title(achievement['position'], achievement['size'],
+                                                    achievement['title'])
+        return image_generator
+
+    def copy(self):
+        """Returns a new ImageGenerator with a copy of the current image. Fonts
+        are shared, so they aren't loaded again"""
+        image_generator = copy.copy(self)
+        image_generator.fonts = dict(self.fonts)
+        image_generator.background = self.background.copy()
+        return image_generator
+
+    def _scaled(self, values):
+        """Returns the layout units values in pixels"""
+        return tuple(value * self.scale for value in values)
+
     def add_font(self, name, path, size):
         """Adds a font to the fonts dictionary, this font will be avaliable to
         use on the other methods"""
-        self.fonts[name] = ImageFont.truetype(path, size)
+        self.fonts[name] = ImageFont.truetype(path, round(size * self.scale))
 
-    def save(self, path):
-        """Saves the image to the specified path"""
-        self.background.save(path)
+    def save(self, path, dpi=None):
+        """Saves the image to the specified path, dpi is stored on the image
+        metadata when it's given"""
+        params = {} if dpi is None else {'dpi': (dpi, dpi)}
+        self.background.save(path, **params)
 
     def write_text(self, text, font, position, horizontal_center=False, color=None):
         """Writes the specified text on the specified position"""
+        self._draw_text(text, font, self._scaled(position), horizontal_center, color)
+
+    def _draw_text(self, text, font, position, horizontal_center=False, color=None):
+        """Writes the specified text on the specified position in pixels"""
         text_color = self.colors['white']
         if color is not None:
             text_color = color
@@ -38,23 +107,53 @@ class ImageGenerator:
     def paste_image(self, path, position):
         """Pastes the specified image on the specified position"""
         plot = Image.open(path, 'r')
-        self.background.paste(plot, position)
+        if self.scale != 1:
+            plot = plot.resize((round(plot.width * self.scale), round(plot.height * self.scale)))
+        self.background.paste(plot, tuple(round(value) for value in self._scaled(position)))
+
+    def paste_plot(self, plot, position):
+        """Pastes a plot rendered by PlotGenerator on the specified position. The
+        plot buffer is used in place, without decoding or copying it"""
+        image = Image.frombuffer('RGBA', plot.size, plot.buffer, 'raw', 'RGBA', 0, 1)
+        self.background.paste(image, tuple(round(value) for value in self._scaled(position)))
+
+    def paste_plots(self, plots):
+        """Pastes the plots rendered by PlotGenerator, by name, on their positions
+        of the layout"""
+        for name, position in self.layout['plots'].items():
+            self.paste_plot(plots[name], position)
 
     def show_achievement(self, icon, position, size, title, description, achieved):
         """Creates an achievement widget on the specified position"""
+        self.write_achievement_title(position, size, title)
+        self.show_achievement_status(icon, position, size, description, achieved)
+
+    def show_achievements(self, achievements):
+        """Draws the achievements of the layout. achievements is a dictionary of
+        (description, achieved) by achievement name, their titles are already
+        drawn by from_layout"""
+        for name, achievement in self.layout['achievements'].items():
+            description, achieved = achievements[name]
+            self.show_achievement_status(achievement['icon'], achievement['position'],
+                                         achievement['size'], description, achieved)
+
+    def write_achievement_title(self, position, size, title):
+        """Writes the title of the achievement widget on the specified position"""
+        self.write_text(title, 'achievement-title', (position[0] + size[0] + 25, position[1] + 5))
+
+    def show_achievement_status(self, icon, position, size, description, achieved):
+        """Draws the data dependent part of the achievement widget on the
+        specified position: the icon, colored if it's achieved, and the description"""
         draw = ImageDraw.Draw(self.background)
-        rect_coords = [position,
-                       (position[0] + size[0], position[1] + size[1])]
+        x, y = self._scaled(position)
+        width, height = self._scaled(size)
+        rect_coords = [(x, y), (x + width, y + height)]
         rect_color = self.colors['foreground'] if achieved else self.colors['light-gray']
-        draw.rounded_rectangle(rect_coords, fill=rect_color, radius=7)
+        draw.rounded_rectangle(rect_coords, fill=rect_color, radius=7 * self.scale)
 
         w, h = draw.textsize(icon, font=self.fonts['icons'])
-        icon_position = (position[0] + (size[0]-w)/2,
-                         (position[1] + (size[1]-h)/2))
-        self.write_text(icon, 'icons', icon_position, color=self.colors['background'])
-
-        title_position = (position[0] + size[0] + 25, position[1] + 5)
-        self.write_text(title, 'achievement-title', title_position)
+        icon_position = (x + (width-w)/2, (y + (height-h)/2))
+        self._draw_text(icon, 'icons', icon_position, color=self.colors['background'])
 
         body_position = (position[0] + size[0] + 25, position[1] + 35)
         self.write_text(description, 'achievement-body', body_position)
@@ -0,0 +1,146 @@
+"""instrumentation module. Contains the Tracer class which records named spans with
+their wall time, cpu time and memory usage, and exports them as a structured trace"""
+import contextlib
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+def peak_rss_mb():
+    """Returns the peak resident set size of the process in MB, None if unknown"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes everywhere else
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+class NullTracer:
+    """Tracer that records nothing, used when instrumentation is disabled"""
+    @contextlib.contextmanager
+    def span(self, name, **args): # pylint: disable=unused-argument
+        """Does nothing"""
+        yield
+
+    def call(self, name, function, *args, **kwargs): # pylint: disable=unused-argument
+        """Returns function(*args, **kwargs)"""
+        return function(*args, **kwargs)
+
+
+class Tracer(NullTracer):
+    """Records named spans. Every span has its wall and cpu time, the peak RSS of
+    the process at the end of the span and, when trace_memory is enabled, the
+    change of the memory allocated through python (tracemalloc).
+
+    profile is the name of a span to run cProfile on and trace_allocations the
+    name of a span to report the top allocations of. Their reports are stored
+    on profiles by span name"""
+    def __init__(self, trace_memory=False, profile=None, trace_allocations=None):
+        self.trace_memory = trace_memory
+        self.profile = profile
+        self.trace_allocations = trace_allocations
+        self.spans = []
+        self.profiles = {}
+        self.start = time.perf_counter()
+        self._depth = threading.local()
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        """Records the code run inside the with block as a span called name. args
+        are stored with the span"""
+        depth = getattr(self._depth, 'value', 0)
+        self._depth.value = depth + 1
+
+        tracing = self.trace_memory or name == self.trace_allocations
+        started = tracing and not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        snapshot = tracemalloc.take_snapshot() if name == self.trace_allocations else None
+        allocated = tracemalloc.get_traced_memory()[0] if tracing else None
+        profiler = cProfile.Profile() if name == self.profile else None
+
+        wall, cpu = time.perf_counter(), time.process_time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            span = {'name': name,
+                    'start': wall - self.start,
+                    'seconds': time.perf_counter() - wall,
+                    'cpu_seconds': time.process_time() - cpu,
+                    'peak_rss_mb': peak_rss_mb(),
+                    'depth': depth,
+                    'thread': threading.get_ident(),
+                    'args': args}
+            if allocated is not None:
+                span['allocated_mb'] = (tracemalloc.get_traced_memory()[0] - allocated) / (1024 * 1024)
+            if profiler is not None:
+                self.profiles[name] = self._profile_report(profiler)
+            if snapshot is not None:
+                self.profiles[name] = self._allocations_report(snapshot)
+            if started and not self.trace_memory:
+                tracemalloc.stop()
+            self.spans.append(span)
+            self._depth.value = depth
+
+    def call(self, name, function, *args, **kwargs):
+        """Returns function(*args, **kwargs), recorded as a span called name"""
+        with self.span(name):
+            return function(*args, **kwargs)
+
+    @staticmethod
+    def _profile_report(profiler, limit=30):
+        """Returns the top functions by cumulative time of profiler"""
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(limit)
+        return stream.getvalue()
+
+    @staticmethod
+    def _allocations_report(snapshot, limit=30):
+        """Returns the lines that allocated the most memory since snapshot"""
+        statistics = tracemalloc.take_snapshot().compare_to(snapshot, 'lineno')
+        return '\n'.join(str(statistic) for statistic in statistics[:limit])
+
+    def to_json(self):
+        """Returns the trace as a dictionary"""
+        return {'spans': sorted(self.spans, key=lambda span: span['start']),
+                'profiles': self.profiles}
+
+    def to_chrome_trace(self):
+        """Returns the trace on the Chrome trace event format, it can be loaded on
+        chrome://tracing or Perfetto"""
+        events = []
+        for span in self.spans:
+            args = {key: value for key, value in span.items()
+                    if key not in ('name', 'start', 'seconds', 'thread', 'depth', 'args')}
+            args.update(span['args'])
+            events.append({'name': span['name'],
+                           'cat': span['name'].split('.')[0],
+                           'ph': 'X',
+                           'ts': span['start'] * 1e6,
+                           'dur': span['seconds'] * 1e6,
+                           'pid': os.getpid(),
+                           'tid': span['thread'],
+                           'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write(self, path, trace_format='json'):
+        """Writes the trace to path, trace_format can be 'json' or 'chrome'"""
+        if trace_format not in ('json', 'chrome'):
+            raise ValueError(f"Unknown trace format '{trace_format}', expected 'json' or 'chrome'")
+        trace = self.to_json() if trace_format == 'json' else self.to_chrome_trace()
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(trace, f, indent=2, default=str)
@@ -1,9 +1,17 @@
+"""Command line entrypoint: python3 ./linux.py <input_path> <output_path> <timezone> <year>"""
 import sys
 from spotify_rewrapped import SpotifyRewrapped
 
 
-input_path = sys.argv[1]
-output_file = sys.argv[2] + '/spotify-rewrapped.png'
-timezone = sys.argv[3] if len(sys.argv) == 4 else 'UTC'
+def main():
+    """Entrypoint"""
+    input_path = sys.argv[1]
+    output_file = sys.argv[2] + '/spotify-rewrapped.png'
+    timezone = sys.argv[3] if len(sys.argv) >= 4 else 'UTC'
+    year = int(sys.argv[4]) if len(sys.argv) >= 5 else None
 
-SpotifyRewrapped(path=input_path, output=output_file, timezone=timezone)
+    SpotifyRewrapped(path=input_path, output=output_file, timezone=timezone, year=year).generate()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,90 +1,375 @@
 """This module contains the PlotGenerator class which is responsible of generating
 the individual plots"""
-import matplotlib.pyplot as plt
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import os
+import struct
+import threading
+
 import matplotlib as mpl
-from  matplotlib import font_manager
+# Plots are always rendered with Agg, this skips the backend auto-detection
+mpl.use('agg')
+import matplotlib.style # pylint: disable=wrong-import-position
+from matplotlib import dates as mdates # pylint: disable=wrong-import-position
+from matplotlib import font_manager # pylint: disable=wrong-import-position
+from matplotlib.backends.backend_agg import FigureCanvasAgg # pylint: disable=wrong-import-position
+from matplotlib.figure import Figure # pylint: disable=wrong-import-position
+import numpy as np # pylint: disable=wrong-import-position
+import pandas as pd # pylint: disable=wrong-import-position
 
-class PlotGenerator:
-    """PlotGenerator. Contains the methods that allow creating the different plots"""
-    def __init__(self, path='./',
-                 style='./resources/spotify.mplstyle',
-                 font='./resources/gotham-medium.otf'):
-        self.path = path
+# Version of the drawing code of PLOTS, part of the RenderCache keys. It has to be
+# increased whenever a change of this module changes the pixels of any plot
+PLOTS_VERSION = 1
+
+# A rendered plot, buffer holds size[0] x size[1] RGBA pixels
+RenderedPlot = namedtuple('RenderedPlot', ['size', 'buffer'])
+
+# (style, font) applied on this process by configure
+_configuration = None
+_configuration_lock = threading.Lock()
+
+def configure(style, font):
+    """Registers the font and applies the matplotlib style. Needs to be called on
+    every process that renders plots, it does nothing if they're already applied"""
+    global _configuration
+    with _configuration_lock:
+        if _configuration == (style, font):
+            return
         font_manager.fontManager.addfont(font)
         mpl.style.use(style)
         mpl.rcParams['font.family'] = 'Gotham'
+        _configuration = (style, font)
+
+
+def new_figure(figsize, dpi):
+    """Returns a Figure attached to an Agg canvas. The figure is not registered
+    on pyplot, so it's freed as soon as it's not referenced anymore"""
+    figure = Figure(figsize=figsize, dpi=dpi)
+    FigureCanvasAgg(figure)
+    return figure
+
+
+def top_artists_by_hours_streamed(data):
+    """Returns a barh plot showing the top 20 top streamed artists"""
+    figure = new_figure(figsize=(12, 6), dpi=60)
+    ax = figure.add_subplot()
+    ax.barh(data.index, data.hours_played)
+    figure.suptitle('Top played artists', fontsize=30)
+    ax.set_xlabel('Hours', fontsize=20)
+    return figure
+
+
+def streamed_hours_by_time_of_the_day(data):
+    """Returns a bar plot showing the streamed hours by time of the day"""
+    figure = new_figure(figsize=(12, 6), dpi=60)
+    ax = figure.add_subplot()
+    ax.bar(data.index, data.hours_played)
+    ax.set_xticks(range(24))
+    ax.set_xticklabels(range(24))
+    figure.suptitle('Hours played by time of day', fontsize=30)
+    return figure
+
+
+def streamed_hours_by_day_of_the_week(data):
+    """Returns a bar plot showing the streamed hours day of the week"""
+    figure = new_figure(figsize=(12, 6), dpi=60)
+    ax = figure.add_subplot()
+    days_labels = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+    # Plot morning times
+    ax.bar(data['morning'].index, data['morning'].hours_played, label='Morning (6 to 12)')
+    # Plot afternoon times
+    ax.bar(data['afternoon'].index,
+           data['afternoon'].hours_played,
+           bottom=data['morning'].hours_played,
+           label='Afternoon (13 to 17)')
+    # Plot evening times
+    ax.bar(data['evening'].index,
+           data['evening'].hours_played,
+           bottom=data['morning'].hours_played+data['afternoon'].hours_played,
+           label='Evening (18 to 21)')
+    # Plot night times
+    ax.bar(data['night'].index, data['night'].hours_played,
+           bottom=data['morning'].hours_played +
+           data['afternoon'].hours_played +
+           data['evening'].hours_played,
+           label='Night (22 to 5)')
+    ax.set_xticks(range(7))
+    ax.set_xticklabels(days_labels)
+    figure.suptitle('Hours played by day of the week', fontsize=30)
+    ax.legend()
+    return figure
+
+
+def cumsum_by_week(data, top_artists):
+    """Returns a plot showing the cumulative streamed hours of your top 10
+    top streamed artists, x is the first day of every week"""
+    figure = new_figure(figsize=(12, 6), dpi=120)
+    ax = figure.add_subplot()
+    for artist in top_artists:
+        selected_artist = data[data.index == artist]
+        ax.plot(selected_artist.week, selected_artist.hours_played, label=artist)
+
+    # The ticks follow the period, months for a year and years for longer ones
+    locator = mdates.AutoDateLocator()
+    ax.xaxis.set_major_locator(locator)
+    ax.xaxis.set_major_formatter(mdates.ConciseDateFormatter(locator))
+    ax.tick_params(axis='x', labelrotation=45)
+    ax.legend()
+    figure.suptitle('Top played artists through the year', fontsize=15)
+    return figure
+
+
+def pie_top_streamed_artists(data):
+    """Returns a pie plot showing the percentage of streamed hours that pertain
+    to your top 20 top streamed artists"""
+    figure = new_figure(figsize=(12, 6), dpi=60)
+    ax = figure.add_subplot()
+    colors = ['#1db954', '#535353']
+    explode = (0.1, 0)
+    ax.pie(data, colors=colors, autopct='%1.0f%%', textprops={'fontsize': 36}, explode=explode)
+    figure.suptitle('My top 20 artists vs others streaming time', fontsize=30)
+    return figure
+
+
+# Maps every plot to the function that draws it
+PLOTS = {'top-artists': top_artists_by_hours_streamed,
+         'hourly-plot': streamed_hours_by_time_of_the_day,
+         'day-of-the-week-plot': streamed_hours_by_day_of_the_week,
+         'artists-through-the-year': cumsum_by_week,
+         'top-20-pie': pie_top_streamed_artists}
+
+
+def render(name, *args, scale=1):
+    """Draws the specified plot and returns it as a RenderedPlot. The buffer is a
+    view of the Agg canvas, no copy is made. scale multiplies the dpi of the plot,
+    so it keeps its layout at any size"""
+    figure = PLOTS[name](*args)
+    if scale != 1:
+        figure.set_dpi(figure.get_dpi() * scale)
+    try:
+        figure.canvas.draw()
+        return RenderedPlot(figure.canvas.get_width_height(), figure.canvas.buffer_rgba())
+    finally:
+        figure.clear()
+
+
+def render_bytes(name, *args, scale=1):
+    """Same as render but the buffer is copied to bytes, so that it can be sent
+    back from a worker process"""
+    plot = render(name, *args, scale=scale)
+    return RenderedPlot(plot.size, bytes(plot.buffer))
+
+
+# Digests of the style and font files, by path, size and mtime
+_file_digests = {}
+
+def file_digest(path):
+    """Returns the sha256 of the content of the file on path, it's only read
+    again when its size or mtime change"""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_digests:
+        with open(path, 'rb') as f:
+            _file_digests[key] = hashlib.sha256(f.read()).digest()
+    return _file_digests[key]
+
+
+def _hash_value(digest, value):
+    """Adds value, the input data of a plot, to digest"""
+    digest.update(type(value).__name__.encode('utf-8'))
+    if isinstance(value, pd.DataFrame):
+        digest.update(repr((list(value.columns), list(map(str, value.dtypes)),
+                            value.index.names)).encode('utf-8'))
+        digest.update(pd.util.hash_pandas_object(value, index=True).values.tobytes())
+    elif isinstance(value, (pd.Series, pd.Index)):
+        digest.update(repr((str(value.dtype), value.name)).encode('utf-8'))
+        digest.update(pd.util.hash_pandas_object(value).values.tobytes())
+    elif isinstance(value, np.ndarray):
+        digest.update(repr((str(value.dtype), value.shape)).encode('utf-8'))
+        digest.update(value.tobytes())
+    elif isinstance(value, dict):
+        for key in sorted(value):
+            digest.update(repr(key).encode('utf-8'))
+            _hash_value(digest, value[key])
+    elif isinstance(value, (list, tuple)):
+        digest.update(str(len(value)).encode('utf-8'))
+        for item in value:
+            _hash_value(digest, item)
+    else:
+        digest.update(repr(value).encode('utf-8'))
+
+
+class RenderCache:
+    """Stores rendered plots on disk, keyed by a hash of everything that changes
+    their pixels: the plot, its input data, the style and font files, the scale,
+    the matplotlib version and PLOTS_VERSION. When the stored plots
+    add up to more than max_bytes the least recently used ones are removed"""
+    def __init__(self, path, max_bytes=64 << 20):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(name, args, style, font, scale):
+        """Returns the key of the plot name drawn from args"""
+        digest = hashlib.sha256()
+        digest.update(repr((name, scale, mpl.__version__, PLOTS_VERSION)).encode('utf-8'))
+        for path in (style, font):
+            digest.update(file_digest(path))
+        _hash_value(digest, list(args))
+        return digest.hexdigest()
+
+    def _file(self, key):
+        """Returns the path of the file that stores the plot of key"""
+        return os.path.join(self.path, f'{key}.rgba')
+
+    def load(self, key):
+        """Returns the cached RenderedPlot of key, None if it isn't cached"""
+        try:
+            with open(self._file(key), 'rb') as f:
+                size = struct.unpack('<II', f.read(8))
+                buffer = f.read()
+            # The mtime keeps the order of use for the eviction
+            os.utime(self._file(key))
+        except (OSError, struct.error):
+            return None
+        if len(buffer) != size[0] * size[1] * 4:
+            return None
+        return RenderedPlot(size, buffer)
+
+    def store(self, key, plot):
+        """Stores plot and evicts the least recently used plots. A cache that
+        can't be written is silently skipped"""
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(f'{self._file(key)}.tmp', 'wb') as f:
+                f.write(struct.pack('<II', *plot.size))
+                f.write(plot.buffer)
+            os.replace(f'{self._file(key)}.tmp', self._file(key))
+            self._evict()
+        except OSError as e:
+            print(f"Could not write the plot cache: {e}")
+
+    def _evict(self):
+        """Removes the least recently used plots until they fit in max_bytes"""
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.rgba'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError: # Already removed by another process
+                pass
+            total -= size
+
+
+class PlotGenerator:
+    """PlotGenerator. Contains the methods that allow creating the different plots.
+
+    On 'serial' mode every plot is rendered as soon as it's requested. On
+    'parallel' mode plots are rendered concurrently on a pool of workers
+    processes. On both modes wait() returns the rendered plots by name.
+
+    scale multiplies the size in pixels of every plot, see render. cache is a
+    RenderCache, plots whose input data didn't change are taken from it instead
+    of being drawn again"""
+    def __init__(self,
+                 style='./resources/spotify.mplstyle',
+                 font='./resources/gotham-medium.otf',
+                 mode='serial', workers=None, scale=1, cache=None):
+        if mode not in ('serial', 'parallel'):
+            raise ValueError(f"Unknown mode '{mode}', expected 'serial' or 'parallel'")
+        self.style = style
+        self.font = font
+        self.mode = mode
+        self.workers = workers
+        self.scale = scale
+        self.cache = cache
+        self.pool = None
+        self.futures = {}
+        self.plots = {}
+        self.keys = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _render(self, name, *args):
+        """Renders the specified plot or submits it to the workers pool"""
+        if self.cache is not None:
+            try:
+                key = self.cache.key(name, args, self.style, self.font, self.scale)
+            except OSError as e:
+                # Without a key the plot is drawn as if there was no cache
+                print(f"Could not use the plot cache: {e}")
+                key = None
+            plot = self.cache.load(key) if key is not None else None
+            if plot is not None:
+                self.plots[name] = plot
+                return
+            if key is not None:
+                self.keys[name] = key
+
+        if self.mode == 'serial':
+            # The font and style are registered when the first plot is rendered
+            configure(self.style, self.font)
+            self.plots[name] = render(name, *args, scale=self.scale)
+            return
+
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers,
+                                            initializer=configure,
+                                            initargs=(self.style, self.font))
+        self.futures[name] = self.pool.submit(render_bytes, name, *args, scale=self.scale)
+
+    def wait(self):
+        """Waits until every requested plot is rendered and returns a dictionary
+        of RenderedPlot by plot name. Raises the exception of the first plot
+        that failed"""
+        futures, self.futures = self.futures, {}
+        plots, self.plots = self.plots, {}
+        keys, self.keys = self.keys, {}
+        for name, future in futures.items():
+            plots[name] = future.result()
+        for name, key in keys.items():
+            self.cache.store(key, plots[name])
+        return plots
+
+    def close(self):
+        """Waits for the pending plots and shuts down the workers pool"""
+        try:
+            self.wait()
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
 
     def top_artists_by_hours_streamed(self, data):
         """Generates a barh plot showing the top 20 top streamed artists"""
-        plt.figure(figsize=(12, 6), dpi=60)
-        plt.barh(data.index, data.hours_played)
-        plt.suptitle('Top played artists', fontsize=30)
-        plt.xlabel('Hours', fontsize=20)
-        plt.savefig(f'{self.path}/top-artists.png')
-        plt.clf()
+        self._render('top-artists', data)
 
     def streamed_hours_by_time_of_the_day(self, data):
         """Generates a bar plot showing the streamed hours by time of the day"""
-        plt.figure(figsize=(12, 6), dpi=60)
-        plt.bar(data.index, data.hours_played)
-        plt.xticks(range(24), range(24))
-        plt.suptitle('Hours played by time of day', fontsize=30)
-        plt.savefig(f'{self.path}/hourly-plot.png')
-        plt.clf()
+        self._render('hourly-plot', data)
 
     def streamed_hours_by_day_of_the_week(self, data):
         """Generates a bar plot showing the streamed hours day of the week"""
-        plt.figure(figsize=(12, 6), dpi=60)
-        days_labels = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-
-        # Plot morning times
-        plt.bar(data['morning'].index, data['morning'].hours_played, label='Morning (6 to 12)')
-        # Plot afternoon times
-        plt.bar(data['afternoon'].index,
-                data['afternoon'].hours_played,
-                bottom=data['morning'].hours_played,
-                label='Afternoon (13 to 17)')
-        # Plot evening times
-        plt.bar(data['evening'].index,
-                data['evening'].hours_played,
-                bottom=data['morning'].hours_played+data['afternoon'].hours_played,
-                label='Evening (18 to 21)')
-        # Plot night times
-        plt.bar(data['night'].index, data['night'].hours_played,
-                bottom=data['morning'].hours_played +
-                data['afternoon'].hours_played +
-                data['evening'].hours_played,
-                label='Night (22 to 5)')
-        plt.xticks(range(7), days_labels)
-        plt.suptitle('Hours played by day of the week', fontsize=30)
-        plt.legend()
-        plt.savefig(f'{self.path}/day-of-the-week-plot.png')
-        plt.clf()
+        self._render('day-of-the-week-plot', data)
 
     def cumsum_by_week(self, data, top_artists):
         """Generates a plot showing the cumulative streamed hours of your top 10
         top streamed artists, xtick is weeks"""
-        plt.figure(figsize=(12, 6), dpi=120)
-        for artist in top_artists:
-            selected_artist = data[data.index == artist]
-            plt.plot(range(52), selected_artist.hours_played, label=artist)
-
-        x_labels = ['New year', 'January', 'February', 'March', 'April', 'May','June',
-                    'July', 'August', 'September', ' October', 'November', 'December']
-        x_ticks = [0, 5, 9, 14, 18, 23, 27, 31, 36, 40, 45, 49, 53]
-        plt.xticks(x_ticks, x_labels, rotation='45')
-        plt.legend()
-        plt.suptitle('Top played artists through the year', fontsize=15)
-        plt.savefig(f'{self.path}/artists-through-the-year.png')
-        plt.clf()
+        self._render('artists-through-the-year', data, top_artists)
 
     def pie_top_streamed_artists(self, data):
         """Generates a pie plot showing the percentage of streamed hours that pertain
         to your top 20 top streamed artists"""
-        plt.figure(figsize=(12, 6), dpi=60)
-        colors = ['#1db954', '#535353']
-        explode = (0.1, 0)
-        plt.pie(data, colors=colors, autopct='%1.0f%%', textprops={'fontsize': 36}, explode=explode)
-        plt.suptitle('My top 20 artists vs others streaming time', fontsize=30)
-        plt.savefig(f'{self.path}/top-20-pie.png')
-        plt.clf()
+        self._render('top-20-pie', data)
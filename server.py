@@ -0,0 +1,325 @@
+"""server module. A local HTTP service that renders the report of an uploaded Spotify
+data archive on a bounded pool of pre-warmed worker processes.
+
+Usage: python3 ./server.py [--host 127.0.0.1] [--port 8000] [--workers N]
+                           [--queue-size 16] [--cache-size 64]
+
+Endpoints:
+  POST /render?timezone=US/Pacific&year=2022  body: the zip archive of the export,
+       returns the png. timezone and year are optional, see batch.py
+  GET  /metrics  returns the queue depth, latency percentiles and cache hit rate
+       as json
+
+Results are cached by the hash of the streaming history files of the archive,
+the timezone and the year, so identical uploads are answered without rendering"""
+import argparse
+import collections
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import zipfile
+import zoneinfo
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from history_schemas import select_history_files
+
+# Largest archive accepted, in bytes
+MAX_UPLOAD_BYTES = 512 << 20
+
+# Largest uncompressed size of the streaming history files of an archive, in bytes
+MAX_HISTORY_BYTES = 1 << 30
+
+# Amount of recent requests the latency percentiles are computed over
+LATENCY_WINDOW = 1024
+
+class QueueFull(Exception):
+    """Raised when the render queue has no room for another job"""
+
+
+class RenderError(Exception):
+    """Raised when the report of a job can't be generated"""
+
+
+class InvalidJob(RenderError):
+    """Raised when the report of a job can't be generated because of its input,
+    like a year without streams"""
+
+
+def read_archive(archive):
+    """Returns the streaming history files of the zip archive (bytes) as a
+    dictionary of contents by file name. Folders of the archive are ignored.
+    Archives whose files add up to more than MAX_HISTORY_BYTES once
+    uncompressed are rejected before reading them"""
+    try:
+        with zipfile.ZipFile(io.BytesIO(archive)) as zip_file:
+            members = {os.path.basename(info.filename): info
+                       for info in zip_file.infolist() if not info.is_dir()}
+            names = select_history_files(list(members))
+            # zipfile never decompresses more than the file_size of a member
+            if sum(members[name].file_size for name in names) > MAX_HISTORY_BYTES:
+                raise ValueError(f'The streaming history files take more than '
+                                 f'{MAX_HISTORY_BYTES} bytes uncompressed')
+            return {name: zip_file.read(members[name]) for name in names}
+    except zipfile.BadZipFile as e:
+        raise ValueError(f'The upload is not a zip archive: {e}') from e
+
+
+def content_key(files, timezone, year):
+    """Returns the cache key of a job, the hash of its files, timezone and year"""
+    digest = hashlib.sha256()
+    for name in sorted(files):
+        digest.update(name.encode('utf-8') + b'\0')
+        digest.update(hashlib.sha256(files[name]).digest())
+    digest.update(f'{timezone}\0{year}'.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def percentile(values, q):
+    """Returns the q (0 to 100) percentile of values by the nearest rank method,
+    None if there are no values"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, -(-len(values) * q // 100) - 1)]
+
+
+def render_files(files, timezone, year):
+    """Generates the report of the streaming history files (contents by name) on
+    a temporary folder and returns the png. It runs on the worker processes.
+    Raises InvalidJob when the files or the period can't make a report, like
+    a year without streams, and RenderError on any other failure"""
+    import batch
+
+    with tempfile.TemporaryDirectory() as folder:
+        for name, content in files.items():
+            with open(os.path.join(folder, name), 'wb') as f:
+                f.write(content)
+        output = os.path.join(folder, 'spotify-rewrapped.png')
+        summary = batch.run_job({'input_dir': folder, 'output_path': output,
+                                 'timezone': timezone, 'year': year, 'cache': False})
+        if summary['status'] != 'ok':
+            # SpotifyRewrapped raises ValueError for histories or periods without streams
+            if summary['error_type'] == 'ValueError':
+                raise InvalidJob(summary['error'])
+            raise RenderError(summary['error'])
+        with open(output, 'rb') as f:
+            return f.read()
+
+
+class RenderService:
+    """Renders reports on a pool of workers. At most queue_size jobs wait for a
+    free worker, submit raises QueueFull beyond that. The last cache_size
+    results are kept by content_key and identical jobs in progress are rendered
+    once.
+
+    executor runs render_files, by default a ProcessPoolExecutor of workers
+    processes warmed up by batch.init_worker. Any concurrent.futures executor
+    can be given, like a ThreadPoolExecutor to run everything in process"""
+    def __init__(self, workers=None, queue_size=16, cache_size=64, executor=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.cache_size = cache_size
+        self.executor = executor
+        if self.executor is None:
+            import batch
+
+            self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                initializer=batch.init_worker)
+            # Start every worker now, so the first jobs don't load the fonts
+            for future in [self.executor.submit(os.getpid) for _ in range(self.workers)]:
+                future.result()
+
+        self._lock = threading.Lock()
+        self._cache = collections.OrderedDict()
+        self._in_progress = {}
+        self._latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self._pending = 0
+        self._counts = collections.Counter()
+
+    def submit(self, files, timezone='UTC', year=None):
+        """Returns the png of the report of files (contents by name) and whether
+        it came from the cache. Blocks until it's rendered"""
+        start = time.perf_counter()
+        key = content_key(files, timezone, year)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self._counts['hits'] += 1
+                self._latencies.append(time.perf_counter() - start)
+                return self._cache[key], True
+            self._counts['misses'] += 1
+            future = self._in_progress.get(key)
+            submitted = future is None
+            if submitted:
+                if self._pending >= self.workers + self.queue_size:
+                    self._counts['rejected'] += 1
+                    raise QueueFull(f'{self._pending} jobs in progress or queued')
+                self._pending += 1
+                future = self.executor.submit(render_files, files, timezone, year)
+                self._in_progress[key] = future
+        # Outside of the lock, the callback runs right away if the job is done
+        if submitted:
+            future.add_done_callback(lambda future: self._done(key, future))
+
+        try:
+            return future.result(), False
+        finally:
+            with self._lock:
+                self._latencies.append(time.perf_counter() - start)
+
+    def _done(self, key, future):
+        """Stores the result of a finished job on the cache"""
+        with self._lock:
+            self._pending -= 1
+            del self._in_progress[key]
+            if future.exception() is not None:
+                self._counts['errors'] += 1
+                return
+            self._counts['rendered'] += 1
+            self._cache[key] = future.result()
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def metrics(self):
+        """Returns the queue, latency (seconds) and cache metrics of the service"""
+        with self._lock:
+            latencies = list(self._latencies)
+            counts = dict(self._counts)
+            pending = self._pending
+            cached = len(self._cache)
+        lookups = counts.get('hits', 0) + counts.get('misses', 0)
+        return {'workers': self.workers,
+                'queue_size': self.queue_size,
+                'in_progress': min(pending, self.workers),
+                'queue_depth': max(0, pending - self.workers),
+                'rendered': counts.get('rendered', 0),
+                'errors': counts.get('errors', 0),
+                'rejected': counts.get('rejected', 0),
+                'latency': {'p50': percentile(latencies, 50),
+                            'p90': percentile(latencies, 90),
+                            'p99': percentile(latencies, 99),
+                            'samples': len(latencies)},
+                'cache': {'entries': cached,
+                          'hits': counts.get('hits', 0),
+                          'misses': counts.get('misses', 0),
+                          'hit_rate': counts.get('hits', 0) / lookups if lookups else None}}
+
+    def shutdown(self):
+        """Stops the workers"""
+        self.executor.shutdown()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """Handles the requests of the RenderService of the server"""
+    def do_GET(self): # pylint: disable=invalid-name
+        """GET /metrics"""
+        if urlparse(self.path).path != '/metrics':
+            self.send_json(404, {'error': f'Unknown path {self.path}'})
+            return
+        self.send_json(200, self.server.service.metrics())
+
+    def do_POST(self): # pylint: disable=invalid-name
+        """POST /render"""
+        url = urlparse(self.path)
+        if url.path != '/render':
+            self.send_json(404, {'error': f'Unknown path {self.path}'})
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        if length > MAX_UPLOAD_BYTES:
+            self.send_json(413, {'error': f'The archive is larger than {MAX_UPLOAD_BYTES} bytes'})
+            return
+
+        # The body is read before validating anything, so that the client gets
+        # the response instead of a broken pipe
+        archive = self.rfile.read(length)
+        query = parse_qs(url.query)
+        timezone = query.get('timezone', ['UTC'])[0]
+        try:
+            zoneinfo.ZoneInfo(timezone)
+        except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+            self.send_json(400, {'error': f'Unknown timezone {timezone!r}'})
+            return
+        try:
+            year = int(query['year'][0]) if 'year' in query else None
+        except ValueError:
+            self.send_json(400, {'error': f'Invalid year {query["year"][0]!r}'})
+            return
+        try:
+            files = read_archive(archive)
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        if not files:
+            self.send_json(400, {'error': 'No streaming history files on the archive'})
+            return
+
+        try:
+            png, cached = self.server.service.submit(files, timezone=timezone, year=year)
+        except QueueFull as e:
+            self.send_json(503, {'error': f'The render queue is full, {e}'}, {'Retry-After': '5'})
+            return
+        except InvalidJob as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        except Exception as e: # pylint: disable=broad-except
+            self.send_json(500, {'error': str(e)})
+            return
+        self.send_body(200, 'image/png', png, {'X-Cache': 'hit' if cached else 'miss'})
+
+    def send_json(self, status, content, headers=None):
+        """Sends content as a json response"""
+        self.send_body(status, 'application/json', json.dumps(content).encode('utf-8'), headers)
+
+    def send_body(self, status, content_type, body, headers=None):
+        """Sends a response with body"""
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def make_server(service, host='127.0.0.1', port=8000):
+    """Returns an http server that answers the requests with service. Port 0
+    picks a free one, see server.server_address"""
+    server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.service = service
+    return server
+
+
+def main():
+    """Entrypoint"""
+    parser = argparse.ArgumentParser(description='Serves the reports of uploaded Spotify data')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='amount of worker processes, defaults to the cpu count')
+    parser.add_argument('--queue-size', type=int, default=16,
+                        help='maximum amount of jobs waiting for a worker')
+    parser.add_argument('--cache-size', type=int, default=64,
+                        help='amount of reports kept in memory')
+    args = parser.parse_args()
+
+    service = RenderService(workers=args.workers, queue_size=args.queue_size,
+                            cache_size=args.cache_size)
+    server = make_server(service, args.host, args.port)
+    print(f'Serving on http://{server.server_address[0]}:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+
+
+if __name__ == '__main__':
+    main()
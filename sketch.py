@@ -0,0 +1,230 @@
+"""sketch module. Summarizes the artists of one or many streaming histories in bounded
+memory, for cohort reports over more histories than fit in a DataManager.
+
+Usage: python3 ./sketch.py <summary> <input_dir>... [--year Y] [--timezone TZ]
+                           [--top N] [--capacity K] [--workers N]
+
+Every history is read once into an ArtistSketch on a pool of worker processes
+and the sketches are merged. The json summary has the exact streams and hours
+played, the top N artists and their share with error bounds and an estimate of
+the amount of unique artists"""
+import argparse
+import json
+import math
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from data_manager import MS_PER_HOUR
+from history_reader import read_file
+from history_schemas import find_history_files
+
+class ArtistSketch:
+    """Bounded memory summary of the ms played by artist.
+
+    The heaviest artists are tracked by a weighted Space-Saving summary of at
+    most capacity artists: the ms played of a tracked artist is overestimated
+    by at most its error, and no untracked artist has more than floor. The
+    streams and ms played are exact and the unique artists are counted with a
+    HyperLogLog of 2 ** precision registers.
+
+    Sketches of different histories can be merged, the bounds still hold for
+    the merged sketch"""
+    def __init__(self, capacity=1000, precision=14):
+        self.capacity = capacity
+        self.precision = precision
+        self.counts = pd.Series([], index=pd.Index([], dtype=object), dtype=np.int64)
+        self.errors = self.counts.copy()
+        self.floor = 0
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+        self.streams = 0
+        self.ms_played = 0
+        self.histories = 0
+
+    @classmethod
+    def from_files(cls, files, year=None, timezone='UTC', min_ms_played=10000, **kwargs):
+        """Returns the sketch of the history of files. Each file is read once and
+        dropped before reading the next one. When year is given only the streams
+        of that year on timezone are counted"""
+        sketch = cls(**kwargs)
+        for file in files:
+            df = read_file(file, year, min_ms_played)
+            if year is not None:
+                local = df.endTime.dt.tz_localize('UTC').dt.tz_convert(timezone)
+                df = df[(local.dt.year == year).values]
+            sketch.add(df.artistName.values, df.msPlayed.values)
+        sketch.histories = 1
+        return sketch
+
+    def add(self, artists, ms_played):
+        """Counts the streams of a chunk of a history, artists and ms_played are
+        arrays with a value per stream"""
+        if len(artists) == 0:
+            return
+        chunk = pd.Series(ms_played, dtype=np.int64).groupby(artists).sum()
+        self.streams += len(artists)
+        self.ms_played += int(chunk.sum())
+        self._update_registers(chunk.index.to_numpy(dtype=object))
+        self._merge_counts(chunk, pd.Series(0, index=chunk.index, dtype=np.int64), 0)
+
+    def merge(self, other):
+        """Adds the counts of the sketch other, of the same precision"""
+        if other.precision != self.precision:
+            raise ValueError(f'Can\'t merge sketches of precision {self.precision} '
+                             f'and {other.precision}')
+        self.streams += other.streams
+        self.ms_played += other.ms_played
+        self.histories += other.histories
+        np.maximum(self.registers, other.registers, out=self.registers)
+        self._merge_counts(other.counts, other.errors, other.floor)
+        return self
+
+    def _merge_counts(self, counts, errors, floor):
+        """Merges the Space-Saving counts of another summary with at most floor ms
+        played for the artists it doesn't have, and keeps the capacity heaviest"""
+        names = self.counts.index.union(counts.index)
+        merged = (self.counts.reindex(names, fill_value=self.floor)
+                  + counts.reindex(names, fill_value=floor))
+        merged_errors = (self.errors.reindex(names, fill_value=self.floor)
+                         + errors.reindex(names, fill_value=floor))
+        self.floor += floor
+        if len(merged) > self.capacity:
+            order = np.argsort(-merged.values, kind='stable')
+            # The dropped artists have at most the count of the heaviest of them
+            self.floor = max(self.floor, int(merged.values[order[self.capacity]]))
+            merged = merged.iloc[order[:self.capacity]]
+            merged_errors = merged_errors.iloc[order[:self.capacity]]
+        self.counts = merged
+        self.errors = merged_errors
+
+    def _update_registers(self, names):
+        """Adds the distinct names to the HyperLogLog registers"""
+        hashes = pd.util.hash_array(names)
+        index = (hashes >> np.uint64(64 - self.precision)).astype(np.int64)
+        rest = hashes << np.uint64(self.precision)
+        # Position of the first 1 bit of the rest of the hash
+        ranks = np.minimum(64 - _bit_length(rest) + 1, 64 - self.precision + 1)
+        np.maximum.at(self.registers, index, ranks.astype(np.uint8))
+
+    def get_top_n_artists(self, n):
+        """Returns the hours_played of the top N artists sorted ascending, like
+        DataManager.get_top_n_artists. error is the most hours_played may be
+        overestimated by"""
+        top = self.counts.sort_values(ascending=False, kind='stable').head(n)
+        return pd.DataFrame({'hours_played': top.values / MS_PER_HOUR,
+                             'error': self.errors[top.index].values / MS_PER_HOUR},
+                            index=top.index.rename('artistName')).iloc[::-1]
+
+    def get_percent_hours_played_in_top_artists(self, n):
+        """Returns [top_hours, non_top_hours] like the DataManager method, with
+        the estimated hours_played of the top N artists"""
+        total_hours = self.ms_played / MS_PER_HOUR
+        top_hours = min(self.get_top_n_artists(n).hours_played.sum(), total_hours)
+        return [top_hours, total_hours - top_hours]
+
+    def top_share(self, n):
+        """Returns the estimated share of the hours played in the top N artists
+        and its low and high bounds"""
+        if self.ms_played == 0:
+            return {'share': None, 'low': None, 'high': None}
+        top = self.counts.sort_values(ascending=False, kind='stable').head(n)
+        low = (top - self.errors[top.index]).sum()
+        # Any untracked artist could have up to floor ms played
+        high = np.sort(np.concatenate([top.values, np.full(n, self.floor)]))[::-1][:n].sum()
+        return {'share': float(min(top.sum() / self.ms_played, 1.0)),
+                'low': float(low / self.ms_played),
+                'high': float(min(high / self.ms_played, 1.0))}
+
+    def exact_top(self, n):
+        """Returns whether the top N artists are guaranteed to be the real ones,
+        their order may still differ"""
+        top = self.counts.sort_values(ascending=False, kind='stable')
+        if len(top) <= n:
+            return self.floor == 0
+        lowest = (top.iloc[:n] - self.errors[top.index[:n]]).min()
+        return bool(lowest >= max(top.iloc[n], self.floor))
+
+    def unique_artists(self):
+        """Returns the estimated amount of unique artists and its low and high
+        bounds, two standard errors away"""
+        registers = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / registers)
+        estimate = alpha * registers ** 2 / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        zeros = np.count_nonzero(self.registers == 0)
+        if estimate <= 2.5 * registers and zeros > 0:
+            estimate = registers * math.log(registers / zeros)
+        error = 2 * 1.04 / math.sqrt(registers) * estimate
+        return {'estimate': round(estimate),
+                'low': max(0, math.floor(estimate - error)),
+                'high': math.ceil(estimate + error)}
+
+    def summary(self, n=20):
+        """Returns the cohort summary of the sketch as a json serializable dictionary"""
+        top = self.get_top_n_artists(n).iloc[::-1]
+        return {'histories': self.histories,
+                'streams': self.streams,
+                'hours_played': self.ms_played / MS_PER_HOUR,
+                'unique_artists': self.unique_artists(),
+                'top_artists': [{'artist': artist, 'hours_played': row.hours_played,
+                                 'error': row.error}
+                                for artist, row in top.iterrows()],
+                'top_share': self.top_share(n),
+                'exact_top': self.exact_top(n)}
+
+
+def _bit_length(values):
+    """Returns the amount of significant bits of every uint64 of values"""
+    values = values.copy()
+    lengths = np.zeros(len(values), dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        large = values >= np.uint64(1 << shift)
+        lengths[large] += shift
+        values[large] >>= np.uint64(shift)
+    return lengths + (values > 0)
+
+
+def sketch_history(path, year=None, timezone='UTC', capacity=1000):
+    """Returns the ArtistSketch of the history on the folder path"""
+    return ArtistSketch.from_files(find_history_files(path), year=year, timezone=timezone,
+                                   capacity=capacity)
+
+
+def sketch_histories(paths, year=None, timezone='UTC', capacity=1000, workers=None):
+    """Returns the merged ArtistSketch of the histories on the folders paths, read
+    on a pool of at most workers processes"""
+    sketch = ArtistSketch(capacity=capacity)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(sketch_history, path, year, timezone, capacity) for path in paths]
+        for future in futures:
+            sketch.merge(future.result())
+    return sketch
+
+
+def main():
+    """Entrypoint"""
+    parser = argparse.ArgumentParser(description='Summarizes the artists of many histories')
+    parser.add_argument('summary', help='path where the json summary is written')
+    parser.add_argument('input_dirs', nargs='+', help='folders with the streaming history files')
+    parser.add_argument('--year', type=int, default=None,
+                        help='only count the streams of year, defaults to the whole history')
+    parser.add_argument('--timezone', default='UTC', help='timezone of the year')
+    parser.add_argument('--top', type=int, default=20, help='amount of top artists')
+    parser.add_argument('--capacity', type=int, default=1000,
+                        help='amount of artists tracked, more is more exact')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='maximum amount of histories read at once, defaults to the cpu count')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    sketch = sketch_histories(args.input_dirs, year=args.year, timezone=args.timezone,
+                              capacity=args.capacity, workers=args.workers)
+    summary = sketch.summary(args.top)
+    summary['seconds'] = time.perf_counter() - start
+    with open(args.summary, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
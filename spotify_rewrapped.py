@@ -1,130 +1,229 @@
 """spotify_rewrapped module, contains SpotifyRewrapped class"""
 
-import glob
 import os
 
-from data_manager import DataManager
-from plot_generator import PlotGenerator
-from image_generator import ImageGenerator
+from history_schemas import find_history_files
+from instrumentation import NullTracer
 
-class SpotifyRewrapped:
-    """Spotify Rewrapped. Main class"""
-
-    def __init__(self, path, output, timezone='UTC'):
-        self.path = path
-        self.output = output
-        self.timezone = timezone
-        self.generate()
-        self.cleanup()
-
-    def generate(self):
-        """Calls the PlotGenerator, DataManager and ImageGenerator to create the result"""
-        # Configure matplotlib
-        pg = PlotGenerator(path=self.path,
-                           style='./resources/spotify.mplstyle',
-                           font='./resources/gotham-medium.otf')
-        dm = DataManager(glob.glob(f'{self.path}/StreamingHistory[0-9].json'), timezone=self.timezone)
+# pandas, matplotlib and PIL take seconds to import, so the modules that depend on
+# them are imported when they're first needed. This keeps the entry points (and
+# the GUI window) fast to start
+# pylint: disable=import-outside-toplevel
 
-        # Top artists by hours_played
-        top = dm.get_top_n_artists(20)
-        pg.top_artists_by_hours_streamed(top)
+# Layout template of the image, see ImageGenerator.from_layout
+LAYOUT = './resources/layout.json'
 
-        # Filter by hours
-        hour = dm.get_streamed_hours_by_time_of_day()
-        pg.streamed_hours_by_time_of_the_day(hour)
+# Stages yielded by SpotifyRewrapped.steps, in order
+STAGES = ['ingest', 'plot.top-artists', 'plot.hourly-plot', 'plot.day-of-the-week-plot',
+          'plot.artists-through-the-year', 'plot.top-20-pie', 'plot.wait', 'compose', 'save']
 
-        # Filter by day of week
-        day_of_the_week = dm.get_streamed_hours_by_day_of_week()
-        pg.streamed_hours_by_day_of_the_week(day_of_the_week)
+class GenerationCancelled(Exception):
+    """Raised by SpotifyRewrapped.generate when it's cancelled"""
 
-        # Cumsum by week (now it has a more decent implementation)
-        cumsum = dm.get_cumsum_by_week(10)
-        top_artists = list(dm.get_top_n_artists(10).index)
-        top_artists.reverse()
 
-        pg.cumsum_by_week(cumsum, top_artists)
+class SpotifyRewrapped:
+    """Spotify Rewrapped. Main class. Creating it does no work, the image is
+    created by generate, or step by step by iterating steps"""
+
+    def __init__(self, path, output, timezone=None, cache=True, incremental=False,
+                 year=None, start=None, end=None, plot_mode='serial', plot_workers=None,
+                 layout=LAYOUT, scale=1, dpi=None,
+                 data_manager=None, plot_generator=None, image_generator=None, tracer=None):
+        """The report is made for year, data_manager.YEAR by default, or for the
+        dates from start (included) to end (excluded) when any of them is given.
+
+        layout is the json template that places every element of the image.
+        scale multiplies the size of the image given by the layout and dpi is
+        stored on the png when it's given.
+
+        cache stores the parsed history and the rendered plots next to the input
+        files, so plots whose data didn't change aren't drawn again.
+        incremental keeps the aggregates of previous runs and only reads the
+        new or changed input files, see IncrementalStore.
+
+        data_manager allows reusing an already loaded DataManager, so reports of
+        several periods and timezones can be made from a single read of the
+        history. It's converted to timezone when one is given, the history is
+        read on UTC by default.
+        plot_generator and image_generator allow reusing an already configured
+        PlotGenerator and an ImageGenerator created by create_image_generator,
+        which is copied, between runs.
+
+        tracer is an instrumentation.Tracer that records a span for every
+        stage, nothing is recorded by default"""
+        self.path = path
+        self.output = output
+        self.timezone = timezone
+        self.cache = cache
+        self.incremental = incremental
+        self.year = year
+        self.start = start
+        self.end = end
+        self.plot_mode = plot_mode
+        self.plot_workers = plot_workers
+        self.layout = layout
+        self.scale = scale
+        self.dpi = dpi
+        self.data_manager = data_manager
+        self.plot_generator = plot_generator
+        self.image_generator = image_generator
+        self.tracer = tracer if tracer is not None else NullTracer()
+
+    @staticmethod
+    def create_image_generator(layout=LAYOUT, scale=1):
+        """Returns an ImageGenerator with the fonts loaded and the elements of the
+        layout template that don't depend on the data (title, github corner,
+        subtitle, footer and achievement titles) already drawn. They're drawn
+        once per template and process, see image_generator.static_layer"""
+        from image_generator import static_layer
+
+        return static_layer(layout, scale=scale)
+
+    def generate(self, progress=None, cancel=None):
+        """Creates the image. progress is called as progress(stage, done, total)
+        after every stage of STAGES. cancel is a threading.Event, when it's set
+        generation stops after the current stage raising GenerationCancelled.
+        Once the last stage is done the image is saved and it can't be cancelled"""
+        steps = self.steps()
+        try:
+            for done, stage in enumerate(steps, 1):
+                if progress is not None:
+                    progress(stage, done, len(STAGES))
+                if cancel is not None and cancel.is_set() and done < len(STAGES):
+                    raise GenerationCancelled()
+        finally:
+            steps.close()
+
+    def steps(self):
+        """Calls the PlotGenerator, DataManager and ImageGenerator to create the result.
+        It's a generator that yields the name of every stage of STAGES once done"""
+        tracer = self.tracer
+        with tracer.span('import'):
+            from data_manager import DataManager, YEAR
+            from history_cache import CACHE_DIR, HistoryCache, IncrementalStore
+            from plot_generator import PlotGenerator, RenderCache
 
-        # Percent of hours played in top artists
-        hours = dm.get_percent_hours_played_in_top_artists(20)
-        pg.pie_top_streamed_artists(hours)
+        # Configure matplotlib
+        pg = self.plot_generator
+        if pg is None:
+            pg = tracer.call('plot.configure', PlotGenerator,
+                             style='./resources/spotify.mplstyle',
+                             font='./resources/gotham-medium.otf',
+                             mode=self.plot_mode,
+                             workers=self.plot_workers,
+                             scale=self.scale,
+                             cache=(RenderCache(os.path.join(self.path, CACHE_DIR, 'plots'))
+                                    if self.cache else None))
+        try:
+            dm = self.data_manager
+            if dm is None:
+                files = find_history_files(self.path)
+                if not files:
+                    raise ValueError(f'No streaming history files found on {self.path}')
+                with tracer.span('ingest', files=len(files)):
+                    if self.incremental:
+                        dm = DataManager(files, timezone=self.timezone or 'UTC',
+                                         incremental=IncrementalStore(self.path))
+                    else:
+                        dm = DataManager(files, timezone=self.timezone or 'UTC',
+                                         cache=HistoryCache(self.path) if self.cache else None)
+            elif self.timezone is not None and dm.timezone != self.timezone:
+                dm = tracer.call('enrich', dm.in_timezone, self.timezone)
+            tracer.call('query.cube', lambda: dm.cube)
+
+            # Select the period of the report
+            if self.start is not None or self.end is not None:
+                dm = tracer.call('query.period', dm.between, self.start, self.end)
+                first_day, end_day = dm.period()
+                everyday_description = ('I streamed at least one track every day\n'
+                                        f'from {first_day} to {end_day - 1} ')
+            else:
+                year = self.year if self.year is not None else YEAR
+                dm = tracer.call('query.period', dm.for_year, year)
+                everyday_description = f'I streamed at least one track every day of {year}\n'
+            if len(dm.cube) == 0:
+                first_day, end_day = dm.period()
+                raise ValueError(f'There are no streams from {first_day} to {end_day - 1}')
+            tracer.call('query.aggregates', dm.aggregates)
+            yield 'ingest'
+
+            # Top artists by hours_played
+            top = tracer.call('query.get_top_n_artists', dm.get_top_n_artists, 20)
+            tracer.call('plot.top-artists', pg.top_artists_by_hours_streamed, top)
+            yield 'plot.top-artists'
+
+            # Filter by hours
+            hour = tracer.call('query.get_streamed_hours_by_time_of_day',
+                               dm.get_streamed_hours_by_time_of_day)
+            tracer.call('plot.hourly-plot', pg.streamed_hours_by_time_of_the_day, hour)
+            yield 'plot.hourly-plot'
+
+            # Filter by day of week
+            day_of_the_week = tracer.call('query.get_streamed_hours_by_day_of_week',
+                                          dm.get_streamed_hours_by_day_of_week)
+            tracer.call('plot.day-of-the-week-plot', pg.streamed_hours_by_day_of_the_week,
+                        day_of_the_week)
+            yield 'plot.day-of-the-week-plot'
+
+            # Cumsum by week (now it has a more decent implementation)
+            cumsum = tracer.call('query.get_cumsum_by_week', dm.get_cumsum_by_week, 10)
+            top_artists = list(dm.get_top_n_artists(10).index)
+            top_artists.reverse()
+
+            tracer.call('plot.artists-through-the-year', pg.cumsum_by_week, cumsum, top_artists)
+            yield 'plot.artists-through-the-year'
+
+            # Percent of hours played in top artists
+            hours = tracer.call('query.get_percent_hours_played_in_top_artists',
+                                dm.get_percent_hours_played_in_top_artists, 20)
+            tracer.call('plot.top-20-pie', pg.pie_top_streamed_artists, hours)
+            yield 'plot.top-20-pie'
+
+            # Wait until every plot is rendered
+            plots = tracer.call('plot.wait', pg.wait)
+            yield 'plot.wait'
+        finally:
+            # Shuts down the workers pool, also when generation is cancelled
+            if self.plot_generator is None:
+                pg.close()
 
         ## GENERATE IMAGE
-        ig = ImageGenerator(size = (1500, 2200))
-        ig.add_font('title', './resources/gotham-medium.otf', 60)
-        ig.add_font('subtitle', './resources/gotham-medium.otf', 40)
-        ig.add_font('achievement-title', './resources/gotham-medium.otf', 24)
-        ig.add_font('achievement-body', './resources/gotham-medium.otf', 18)
-        ig.add_font('icons', './resources/font-awesome-5-free-solid-900.otf', 58)
+        if self.image_generator is None:
+            ig = tracer.call('image.static', self.create_image_generator, self.layout, self.scale)
+        else:
+            ig = tracer.call('image.static', self.image_generator.copy)
 
-        # Draw title
-        ig.write_text('Spotify rewrapped', 'title', (0, 50), horizontal_center=True)
-
-        # Draw github corner
-        ig.paste_image('./resources/github-corner-left.png', (0, 0))
-
-        # Draw top played artists plot
-        ig.paste_image(f'{self.path}/top-artists.png', (25, 175))
-
-        # Draw top played artists plot
-        ig.paste_image(f'{self.path}/top-20-pie.png', (750, 175))
-
-        # Draw hourly plot
-        ig.paste_image(f'{self.path}/hourly-plot.png', (25, 550))
-
-        # Draw day of the week plot
-        ig.paste_image(f'{self.path}/day-of-the-week-plot.png', (750, 550))
-
-        # Draw artists through the year
-        ig.paste_image(f'{self.path}/artists-through-the-year.png', (25, 925))
-
-        # Draw subtitle
-        ig.write_text('Achievements', 'subtitle', (25, 1675))
+        tracer.call('image.paste', ig.paste_plots, plots)
 
         #Achievements
         # Christmas spirit
-        christmas_spirit = dm.all_i_want_for_christmas_is_you()
-        ig.show_achievement('\uf7aa', (25, 1750), (100, 100), 'Christmas spirit',
-                            'I streamed at least 1 hour of\n'
-                            'All I Want for Christmas Is You by Mariah Carey\n'
-                            '({:.2f}/{:.1f})'.format(christmas_spirit['hours'], 1.0),
-                            christmas_spirit['achieved'])
-
+        christmas_spirit = tracer.call('query.all_i_want_for_christmas_is_you',
+                                       dm.all_i_want_for_christmas_is_you)
         # Halloween
-        halloween = dm.deffinitive_halloween_experience()
-        ig.show_achievement('\uf717', ((ig.W/2) + 25, 1750), (100, 100),
-                            'The deffinitive Halloween experience',
-                            'I streamed Thriller by Michael Jackson during\n'
-                            'Halloween', halloween)
-
+        halloween = tracer.call('query.deffinitive_halloween_experience',
+                                dm.deffinitive_halloween_experience)
         # Variety
-        variety = dm.variety_is_the_spice_of_life()
-        ig.show_achievement('\uf200', (25, 1900), (100, 100),
-                            'Variety is the Spice of Life',
-                            'Less than 30% of my total streams are from my'
-                            '\ntop 20 streamed artists', variety)
-
+        variety = tracer.call('query.variety_is_the_spice_of_life',
+                              dm.variety_is_the_spice_of_life)
         # Everyday routine
-        everyday = dm.days_streamed()
-        ig.show_achievement('\uf274', ((ig.W/2) + 25, 1900), (100, 100),
-                            'Everyday routine',
-                            'I streamed at least one track every day of 2022'
-                            '\n({}/{})'.format(everyday['days'], 365), everyday['achieved'])
-
-        # Print footer
-        ig.write_text('Find me on github: https://github.com/willyw0nka/spotify-rewrapped',
-                      'achievement-title', (0, 2100), horizontal_center=True)
-        ig.write_text('This is not affiliated with Spotify', 'achievement-title',
-                      (0, 2150), color=ig.colors['light-gray'], horizontal_center=True)
+        everyday = tracer.call('query.days_streamed', dm.days_streamed)
+
+        achievements = {
+            'christmas-spirit': ('I streamed at least 1 hour of\n'
+                                 'All I Want for Christmas Is You by Mariah Carey\n'
+                                 '({:.2f}/{:.1f})'.format(christmas_spirit['hours'], 1.0),
+                                 christmas_spirit['achieved']),
+            'halloween': ('I streamed Thriller by Michael Jackson during\n'
+                          'Halloween', halloween),
+            'variety': ('Less than 30% of my total streams are from my'
+                        '\ntop 20 streamed artists', variety),
+            'everyday': (everyday_description +
+                         '({}/{})'.format(everyday['days'], everyday['total']),
+                         everyday['achieved'])}
+        tracer.call('image.achievements', ig.show_achievements, achievements)
+        yield 'compose'
 
         # Save image
-        ig.save(self.output)
+        tracer.call('image.save', ig.save, self.output, self.dpi)
+        yield 'save'
         print('Image generated successfully!')
-
-    def cleanup(self):
-        """Removes all the intermediate png generated files"""
-        # Cleanup
-        os.remove(f'{self.path}/top-artists.png')
-        os.remove(f'{self.path}/top-20-pie.png')
-        os.remove(f'{self.path}/hourly-plot.png')
-        os.remove(f'{self.path}/day-of-the-week-plot.png')
-        os.remove(f'{self.path}/artists-through-the-year.png')
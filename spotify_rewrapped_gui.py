@@ -2,11 +2,17 @@
 Windows users"""
 import tkinter as tk
 from tkinter import Tk, W, E, N, filedialog, messagebox
-from tkinter.ttk import Frame, Button, Entry, Label
+from tkinter.ttk import Frame, Button, Entry, Label, Progressbar
 
-import glob
+import multiprocessing
+import queue
+import threading
 
-from spotify_rewrapped import SpotifyRewrapped
+from history_schemas import find_history_files
+from spotify_rewrapped import SpotifyRewrapped, GenerationCancelled, STAGES
+
+# Milliseconds between checks of the messages sent by the generation thread
+POLL_INTERVAL = 100
 
 class SpotifyRewrappedGUI(Frame):
     """SpotifyRewrappedGUI contains the code needed to render the GUI"""
@@ -15,15 +21,81 @@ class SpotifyRewrappedGUI(Frame):
         self.root = root
         self.input_path = ''
         self.output_file = ''
+        self.messages = queue.Queue()
+        self.cancel_event = threading.Event()
+        self.worker = None
 
         self.init_ui()
 
     def launch(self):
-        """Runs an instance of SpotifyRewrapped to generate the desired png"""
-        SpotifyRewrapped(path=self.input_path, output=self.output_file)
-        messagebox.showinfo(title='Spotify rewrapped',
-                            message='Success!\n'
-                            'You can check your results at {}'.format(self.output_file))
+        """Runs an instance of SpotifyRewrapped on a background thread to generate
+        the desired png, the window keeps responding while it runs"""
+        if self.worker is not None:
+            return
+        self.cancel_event.clear()
+        self.progressbar.configure(value=0)
+        self.status.configure(text='Starting...')
+        self.generate_button.configure(state='disabled')
+        self.cancel_button.configure(state='normal')
+
+        self.worker = threading.Thread(target=self.generate,
+                                       args=(self.input_path, self.output_file),
+                                       daemon=True)
+        self.worker.start()
+        self.root.after(POLL_INTERVAL, self.poll)
+
+    def generate(self, input_path, output_file):
+        """Runs on the background thread. Tk is not thread safe, so the progress
+        and the result are sent to the main thread through messages"""
+        try:
+            SpotifyRewrapped(path=input_path, output=output_file).generate(
+                progress=lambda stage, done, total: self.messages.put(('progress', stage, done)),
+                cancel=self.cancel_event)
+            self.messages.put(('done',))
+        except GenerationCancelled:
+            self.messages.put(('cancelled',))
+        except Exception as e: # pylint: disable=broad-except
+            self.messages.put(('error', f'{type(e).__name__}: {e}'))
+
+    def cancel(self):
+        """Asks the background thread to stop after the current stage"""
+        self.cancel_event.set()
+        self.cancel_button.configure(state='disabled')
+        self.status.configure(text='Cancelling...')
+
+    def poll(self):
+        """Handles the messages sent by the background thread, runs on the main
+        thread every POLL_INTERVAL ms while generating"""
+        while True:
+            try:
+                message = self.messages.get_nowait()
+            except queue.Empty:
+                break
+            if message[0] == 'progress':
+                _, stage, done = message
+                self.progressbar.configure(value=done)
+                self.status.configure(text=f'{stage} ({done}/{len(STAGES)})')
+            else:
+                self.finish(*message)
+                return
+        self.root.after(POLL_INTERVAL, self.poll)
+
+    def finish(self, result, error=None):
+        """Restores the buttons and shows the result of the generation"""
+        self.worker = None
+        self.generate_button.configure(state='normal')
+        self.cancel_button.configure(state='disabled')
+        if result == 'done':
+            self.status.configure(text='Done')
+            messagebox.showinfo(title='Spotify rewrapped',
+                                message='Success!\n'
+                                'You can check your results at {}'.format(self.output_file))
+        elif result == 'cancelled':
+            self.progressbar.configure(value=0)
+            self.status.configure(text='Cancelled')
+        else:
+            self.status.configure(text='Failed')
+            messagebox.showerror(title='Spotify rewrapped', message=error)
 
     def set_input_path(self):
         """Displays an askdirectory dialog and saves the result to allow
@@ -36,7 +108,7 @@ class SpotifyRewrappedGUI(Frame):
         self.entry_input_path.configure(state='disabled')
 
         self.listbox.configure(state='normal')
-        for file in glob.glob(f'{self.input_path}/StreamingHistory[0-9].json'):
+        for file in find_history_files(self.input_path):
             print(file)
             self.listbox.insert(tk.END, file)
         self.listbox.configure(state='disabled')
@@ -68,6 +140,8 @@ class SpotifyRewrappedGUI(Frame):
         self.rowconfigure(3, pad=3)
         self.rowconfigure(4, pad=3)
         self.rowconfigure(5, pad=3)
+        self.rowconfigure(6, pad=3)
+        self.rowconfigure(7, pad=3)
 
         current_row = 0
         Label(self, text='Spotify rewrapped').grid(row=current_row,
@@ -96,10 +170,18 @@ class SpotifyRewrappedGUI(Frame):
                                                                     column=3)
 
         current_row = 5
-        Button(self, text='Generate', command=self.launch).grid(row=current_row,
-                                                                column=0,
-                                                                columnspan=2,
-                                                                sticky=E+W)
+        self.progressbar = Progressbar(self, maximum=len(STAGES))
+        self.progressbar.grid(row=current_row, column=0, columnspan=4, sticky=E+W)
+
+        current_row = 6
+        self.status = Label(self, text='')
+        self.status.grid(row=current_row, column=0, columnspan=4, sticky=W)
+
+        current_row = 7
+        self.generate_button = Button(self, text='Generate', command=self.launch)
+        self.generate_button.grid(row=current_row, column=0, sticky=E+W)
+        self.cancel_button = Button(self, text='Cancel', command=self.cancel, state='disabled')
+        self.cancel_button.grid(row=current_row, column=1, sticky=E+W)
         Button(self, text='Quit', command=self.root.destroy).grid(row=current_row,
                                                                   column=2,
                                                                   columnspan=2,
@@ -110,6 +192,8 @@ class SpotifyRewrappedGUI(Frame):
 
 def main():
     """Entrypoint"""
+    # Big histories are read on workers processes, which need it on the frozen exe
+    multiprocessing.freeze_support()
     root = Tk()
     SpotifyRewrappedGUI(root)
     root.mainloop()